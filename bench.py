@@ -0,0 +1,435 @@
+# Бенчмарки бота без Telegram: вместо Bot API - локальная заглушка FakeTelegramAPI.
+# Запуск: python bench.py [due_query] [sweep] [addproblem] [callbacks] [параметры]
+# Например: python bench.py sweep --users 200 --lists 3 --tasks 50 --latency 0.02 --rate-429 0.01
+# Одинаковые параметры и --seed дают одинаковые данные и одинаковые ответы заглушки.
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Токен должен проходить проверку формата TeleBot; запросы уходят в заглушку
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+import telebot
+from telebot import types
+
+import main
+
+# Те же выборки, что FileStorage.overdue_tasks и FileStorage.pending_tasks
+DUE_QUERY = (
+    "SELECT problem_id, problem, time_send, notify_count, notified_at, lease_until FROM problems "
+    "WHERE confirmed = FALSE AND (due_at IS NULL OR due_at <= ?) ORDER BY due_at, problem_id"
+)
+PENDING_QUERY = (
+    "SELECT problem_id, due_at, notified_at, notify_count, lease_until FROM problems WHERE confirmed = FALSE"
+)
+
+DUE_TIME = "2000-01-01 08:00:00"
+FUTURE_TIME = "2999-01-01 08:00:00"
+
+
+def fill_problems(conn, pending, confirmed):
+    # Выполненные - в 2020 году, ожидающие - в 2030-м, due_at в UTC
+    conn.executemany(
+        "INSERT INTO problems (problem, time_send, due_at, confirmed) VALUES (?, ?, ?, TRUE)",
+        (("done", f"2020-01-01 {i % 24:02d}:{i % 60:02d}:00", 1577836800 + i % 86400) for i in range(confirmed))
+    )
+    conn.executemany(
+        "INSERT INTO problems (problem, time_send, due_at) VALUES (?, ?, ?)",
+        (("todo", f"2030-01-01 {i % 24:02d}:{i % 60:02d}:00", 1893456000 + i % 86400) for i in range(pending))
+    )
+    conn.commit()
+
+
+def time_query(conn, query, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(query, params).fetchall()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.api.handle(self)
+
+    def do_POST(self):
+        self.server.api.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramAPI:
+    # Заглушка Bot API: отвечает на любой метод, записывает вызовы (время получения,
+    # метод, параметры), отвечает с задержкой latency +- jitter секунд и с
+    # вероятностью rate_429 - ошибкой 429 с retry_after
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = []  # (time.perf_counter(), метод, параметры)
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        telebot.apihelper.API_URL = f"http://127.0.0.1:{self.server.server_port}/bot{{0}}/{{1}}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls = []
+
+    def count(self, method):
+        with self.lock:
+            return sum(1 for _, name, _ in self.calls if name == method)
+
+    def received(self, method):
+        with self.lock:
+            return [at for at, name, _ in self.calls if name == method]
+
+    def handle(self, request):
+        url = urlsplit(request.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        if body and "json" in request.headers.get("Content-Type", ""):
+            params.update(json.loads(body))
+        elif body and "form-urlencoded" in request.headers.get("Content-Type", ""):
+            params.update({name: values[0] for name, values in parse_qs(body.decode()).items()})
+
+        with self.lock:
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            limited = method != "getUpdates" and self.rng.random() < self.rate_429
+        if delay:
+            time.sleep(delay)
+
+        if limited:
+            with self.lock:
+                self.rejected += 1
+            self.reply(request, 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+            return
+
+        with self.lock:
+            self.calls.append((time.perf_counter(), method, params))
+            message_id = len(self.calls)
+        self.reply(request, 200, {"ok": True, "result": self.result(method, params, message_id)})
+
+    @staticmethod
+    def result(method, params, message_id):
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id") or 0)
+            return {"message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": ""}
+        return True
+
+    @staticmethod
+    def reply(request, status, payload):
+        body = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def reset_bot_state():
+    # Новое хранилище в текущем каталоге и пустые очередь напоминаний, пул и кэш
+    for key in list(main.open_connections):
+        main.close_db_connection(key)
+    with main.due_lock:
+        main.due_queue.clear()
+        main.due_index.clear()
+    with main.listing_lock:
+        main.listing_cache.clear()
+    main.storage = main.InstrumentedStorage(main.create_storage())
+    main.chat_timezones.clear()
+    with main.callback_lock:
+        main.callback_lists.clear()
+
+
+def generate_users(users, lists, tasks, due_fraction, rng):
+    # Пользователи 1..users, у каждого lists списков по tasks задач, доля
+    # due_fraction задач уже наступила. Возвращает [(chat_id, список, [(problem_id, наступила)])]
+    created = []
+    tz = main.get_timezone(main.DEFAULT_TIMEZONE)
+    due_at = {time_send: main.local_epoch(time_send, tz) for time_send in (DUE_TIME, FUTURE_TIME)}
+    for chat_id in range(1, users + 1):
+        for n in range(lists):
+            list_name = f"list{n}"
+            main.storage.create_list(chat_id, list_name)
+            times = [DUE_TIME if rng.random() < due_fraction else FUTURE_TIME for _ in range(tasks)]
+            rows = [(f"task {chat_id}/{n}/{i}", time_send, due_at[time_send], None) for i, time_send in enumerate(times)]
+            added = main.storage.add_problems(chat_id, list_name, rows)
+            created.append((chat_id, list_name, [(task_id, at == due_at[DUE_TIME]) for task_id, at in added]))
+    return created
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def print_header():
+    print(f"{'сценарий':<22}{'число':>8}{'ошибок':>8}{'p50, мс':>10}{'p99, мс':>10}{'в секунду':>12}")
+
+
+def print_result(label, latencies, errors, duration):
+    if not latencies:
+        print(f"{label:<22}{0:>8}{errors:>8}")
+        return
+    print(
+        f"{label:<22}{len(latencies):>8}{errors:>8}"
+        f"{percentile(latencies, 0.5) * 1000:>10.2f}{percentile(latencies, 0.99) * 1000:>10.2f}"
+        f"{len(latencies) / duration if duration else 0:>12.1f}"
+    )
+
+
+def message_update(update_id, chat_id, text):
+    return types.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    })
+
+
+def callback_update(update_id, chat_id, data):
+    return types.Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": ""},
+        },
+    })
+
+
+def process_updates(updates, concurrency):
+    # Обработчики вызываются так же, как в режиме вебхука: bot.process_new_updates
+    # без пула TeleBot. Возвращает (задержки, ошибки, общее время)
+    main.bot.threaded = False
+    latencies = []
+    errors = 0
+
+    def process(update):
+        started = time.perf_counter()
+        try:
+            main.bot.process_new_updates([update])
+            failed = False
+        except Exception:
+            failed = True
+        return time.perf_counter() - started, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, failed in executor.map(process, updates):
+            latencies.append(latency)
+            errors += failed
+    return latencies, errors, time.perf_counter() - started
+
+
+def bench_due_query(args, pending=100, confirmed_counts=(0, 1000, 10000, 100000), repeat=200):
+    # Сравниваем текущую схему без индекса по (confirmed, due_at) и с ним
+    print(f"{'схема':<12}{'выполнено':>10}{'due, мкс':>12}{'pending, мкс':>15}  план")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, indexed in (("без индекса", False), ("текущая", True)):
+            for confirmed in confirmed_counts:
+                conn = sqlite3.connect(os.path.join(tmp, f"{indexed}_{confirmed}.sqlite"))
+                main.apply_migrations(conn, main.FILE_MIGRATIONS)
+                if not indexed:
+                    conn.execute("DROP INDEX idx_problems_archive")
+                fill_problems(conn, pending, confirmed)
+
+                params = (1893499200,)  # 2030-01-01 12:00 UTC
+                plan = conn.execute("EXPLAIN QUERY PLAN " + DUE_QUERY, params).fetchall()[0][3]
+                due_us = time_query(conn, DUE_QUERY, params, repeat)
+                pending_us = time_query(conn, PENDING_QUERY, (), repeat)
+                print(f"{label:<12}{confirmed:>10}{due_us:>12.1f}{pending_us:>15.1f}  {plan}")
+                conn.close()
+
+
+def bench_sweep(args, api, created):
+    # Прогрев (миграции и загрузка очереди), затем --passes проходов напоминаний:
+    # время прохода и задержка от его начала до получения сообщения заглушкой
+    started = time.perf_counter()
+    main.warm_up_storage()
+    print(f"прогрев: {time.perf_counter() - started:.2f} с, списков - {len(created)}")
+
+    main.send_queue.global_bucket = main.TokenBucket(args.send_rate, capacity=args.send_rate)
+    main.send_queue.chat_rate = args.chat_rate
+    main.send_queue.chat_buckets.clear()
+    if not getattr(main.send_queue, "bench_started", False):
+        main.send_queue.start()
+        main.send_queue.bench_started = True
+
+    # В режиме дайджеста - одно сообщение на чат с наступившими задачами
+    main.REMINDER_DIGEST = args.digest
+    if args.digest:
+        due = len({chat_id for chat_id, _, tasks in created if any(is_due for _, is_due in tasks)})
+    else:
+        due = sum(is_due for _, _, tasks in created for _, is_due in tasks)
+    now = time.time()
+    pass_times = []
+    delays = []
+    delivered = 0
+    delivery_time = 0.0
+    for n in range(args.passes):
+        api.reset()
+        # Каждый следующий проход - время повторного напоминания предыдущего
+        now += main.renotify_delay(n) + 1
+        pass_started = time.perf_counter()
+        main.notify_due_tasks(now)
+        pass_times.append(time.perf_counter() - pass_started)
+
+        deadline = time.monotonic() + args.timeout
+        while api.count("sendMessage") < due and time.monotonic() < deadline:
+            time.sleep(0.01)
+        received = api.received("sendMessage")
+        delivered += len(received)
+        delays += [at - pass_started for at in received]
+        delivery_time += max(received, default=pass_started) - pass_started
+        if len(received) < due:
+            print(f"проход {n + 1}: доставлено {len(received)} из {due} за {args.timeout} с")
+        # Заглушка получает сообщение раньше, чем отправитель отметит его доставленным:
+        # ждём, пока очередь отпустит все задания, иначе следующий проход не поставит
+        # в очередь ещё "отправляемые" задачи, а их доставка запишется после сброса
+        while main.send_queue.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Между настоящими проходами доставка успевает записаться и снять аренду
+        main.send_queue.flush_deliveries()
+
+    print_header()
+    print_result("проход напоминаний", pass_times, 0, sum(pass_times))
+    print_result("доставка", delays, due * args.passes - delivered, delivery_time)
+
+
+def bench_addproblem(args, api, created):
+    rng = random.Random(args.seed)
+    updates = []
+    for n in range(args.requests):
+        chat_id, list_name, _ = rng.choice(created)
+        text = f"/addproblem {list_name}:bench{n}::{rng.randrange(24)}:{rng.randrange(60)}"
+        updates.append(message_update(n + 1, chat_id, text))
+
+    api.reset()
+    latencies, errors, duration = process_updates(updates, args.concurrency)
+    print_header()
+    print_result("/addproblem", latencies, errors, duration)
+
+
+def bench_callbacks(args, api, created):
+    # Вперемешку: листание списка, клавиатура удаления и подтверждение наступивших задач
+    rng = random.Random(args.seed)
+    due_tasks = [(chat_id, list_name, task_id) for chat_id, list_name, tasks in created
+                 for task_id, is_due in tasks if is_due]
+    rng.shuffle(due_tasks)
+    updates = []
+    for n in range(args.requests):
+        chat_id, list_name, _ = rng.choice(created)
+        kind = rng.randrange(3)
+        if kind == 0 and due_tasks:
+            chat_id, list_name, task_id = due_tasks.pop()
+            data = main.encode_callback("confirm_task", list_name, task_id)
+        elif kind == 1:
+            data = main.encode_callback("list_page", list_name, rng.randrange(3))
+        else:
+            data = main.encode_callback("del_page", list_name, rng.randrange(3))
+        updates.append(callback_update(n + 1, chat_id, data))
+
+    api.reset()
+    latencies, errors, duration = process_updates(updates, args.concurrency)
+    print_header()
+    print_result("callback", latencies, errors, duration)
+
+
+BENCHMARKS = {
+    "due_query": bench_due_query,
+    "sweep": bench_sweep,
+    "addproblem": bench_addproblem,
+    "callbacks": bench_callbacks,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Бенчмарки бота с заглушкой Telegram API")
+    parser.add_argument("names", nargs="*", help=f"сценарии: {', '.join(BENCHMARKS)} (по умолчанию все)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--lists", type=int, default=2, help="списков у пользователя")
+    parser.add_argument("--tasks", type=int, default=20, help="задач в списке")
+    parser.add_argument("--due", type=float, default=0.25, help="доля уже наступивших задач")
+    parser.add_argument("--requests", type=int, default=500, help="обновлений в addproblem и callbacks")
+    parser.add_argument("--concurrency", type=int, default=1, help="потоков обработки обновлений")
+    parser.add_argument("--passes", type=int, default=3, help="проходов напоминаний в sweep")
+    parser.add_argument("--digest", action="store_true", help="sweep в режиме REMINDER_DIGEST")
+    parser.add_argument("--timeout", type=float, default=60, help="ожидание доставки одного прохода, с")
+    parser.add_argument("--send-rate", type=float, default=1000, help="глобальный лимит отправки, в секунду")
+    parser.add_argument("--chat-rate", type=float, default=1000, help="лимит отправки в чат, в секунду")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс задержки, с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, с")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"неизвестный сценарий {name}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    cwd = os.getcwd()
+    api = None
+    for name in args.names or list(BENCHMARKS):
+        print(f"== {name}")
+        if name == "due_query":
+            BENCHMARKS[name](args)
+            continue
+
+        if api is None:
+            api = FakeTelegramAPI(args.latency, args.jitter, args.rate_429, args.retry_after, args.seed)
+            api.start()
+        # Каждый сценарий - на свежих данных в отдельном каталоге
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            reset_bot_state()
+            created = generate_users(args.users, args.lists, args.tasks, args.due, random.Random(args.seed))
+            BENCHMARKS[name](args, api, created)
+            reset_bot_state()
+            os.chdir(cwd)
+    if api is not None:
+        print(f"ответов 429 от заглушки: {api.rejected}")
+        api.stop()
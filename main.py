@@ -1,47 +1,394 @@
 import telebot
 from telebot import types
+import pytz
+import asyncio
+import base64
+import csv
+import functools
+import hashlib
+import inspect
+import io
+import json
 import os
+import sys
 import sqlite3
 import re
+import struct
+import tempfile
+import heapq
+import multiprocessing
+import queue
 import threading
 import time
-from datetime import datetime
-
-TOKEN = 'ttt'
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+TOKEN = os.environ.get("BOT_TOKEN", 'ttt')
 bot = telebot.TeleBot(TOKEN)
 
 MAX_DBS_PER_USER = 20
+RENOTIFY_INTERVAL = 120  # секунд между повторными напоминаниями
+# Повтор после k-го напоминания - через RENOTIFY_INTERVAL * RENOTIFY_BACKOFF^(k-1) секунд,
+# но не позже RENOTIFY_MAX_INTERVAL; RENOTIFY_BACKOFF = 1 - всегда через RENOTIFY_INTERVAL
+RENOTIFY_BACKOFF = float(os.environ.get("RENOTIFY_BACKOFF", "1"))
+RENOTIFY_MAX_INTERVAL = int(os.environ.get("RENOTIFY_MAX_INTERVAL", "86400"))
+# REMINDER_DIGEST=1 - все напоминания чата за проход одним сообщением: просроченные
+# задачи всех его списков, по DIGEST_PAGE_SIZE на страницу, у каждой своя кнопка
+REMINDER_DIGEST = os.environ.get("REMINDER_DIGEST") == "1"
+DIGEST_PAGE_SIZE = int(os.environ.get("DIGEST_PAGE_SIZE", "10"))
+MAX_IDLE_WAIT = 3600  # поток напоминаний просыпается хотя бы раз в час, даже без задач
+
+# Очередь отправки напоминаний (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в чат)
+SEND_QUEUE_SIZE = 10000
+SEND_WORKERS = 4
+GLOBAL_SEND_RATE = 30
+CHAT_SEND_RATE = 1
+SEND_MAX_RETRIES = 5
+# Запись last_notification после доставки: пачкой раз в DELIVERY_FLUSH_INTERVAL секунд,
+# одной транзакцией на БД. DELIVERY_SYNCHRONOUS - режим PRAGMA synchronous для этих
+# транзакций: FULL - fsync на каждую пачку, NORMAL - как остальные записи в WAL,
+# OFF - без fsync. Чем реже и "мягче" запись, тем выше пропускная способность, но
+# после сбоя часть уже доставленных напоминаний может прийти повторно.
+DELIVERY_FLUSH_INTERVAL = float(os.environ.get("DELIVERY_FLUSH_INTERVAL", "5"))
+DELIVERY_SYNCHRONOUS = os.environ.get("DELIVERY_SYNCHRONOUS", "NORMAL").upper()
+if DELIVERY_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL"):
+    raise ValueError(f"DELIVERY_SYNCHRONOUS: ожидается OFF, NORMAL или FULL, получено {DELIVERY_SYNCHRONOUS}")
+# Аренда доставки: проход напоминаний закрепляет задачу за процессом на DELIVERY_LEASE
+# секунд (lease_owner, lease_until в problems), отправитель продлевает аренду на столько
+# же, когда берёт задание из очереди; запись notified_at или неудачная отправка её
+# снимает. Аренду упавшего процесса забирают после её истечения.
+DELIVERY_LEASE = int(os.environ.get("DELIVERY_LEASE", "300"))
+lease_owners = {}  # pid -> метка процесса в lease_owner
+
+# Процессы напоминаний: 0 - поток в основном процессе, N > 0 - N процессов,
+# каждый обслуживает чаты, чей хэш chat_id попадает в его долю. Общий лимит
+# GLOBAL_SEND_RATE делится между процессами поровну: у каждого своя очередь
+# отправки с GLOBAL_SEND_RATE / N сообщений в секунду
+REMINDER_SHARDS = int(os.environ.get("REMINDER_SHARDS", "0"))
+
+# asyncio-режим (python main.py async): потоков для обработчиков и работы с хранилищем
+ASYNC_EXECUTOR_WORKERS = int(os.environ.get("ASYNC_EXECUTOR_WORKERS", "16"))
+
+# Режим вебхука (python main.py webhook): локальный HTTP-сервер принимает обновления,
+# WEBHOOK_WORKERS потоков их обрабатывают; обновления одного чата - по порядку.
+# WEBHOOK_URL - публичный адрес для setWebhook (без него вебхук не регистрируется,
+# сервер можно проверять локально, отправляя JSON на WEBHOOK_HOST:WEBHOOK_PORT)
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Список задач в /addproblem и /delproblem: задач на странице и сколько списков
+# держать в кэше готовых сообщений
+PROBLEMS_PAGE_SIZE = 20
+LISTING_CACHE_SIZE = 1000
+MAX_MESSAGE_LENGTH = 4096
+MAX_RECURRENCE_SHOWN = 40  # длиннее правило повторения в списке обрезается
+
+# Массовое добавление (/addproblems, CSV/JSON-файл) и выгрузка (/exportproblems)
+IMPORT_MAX_TASKS = 1000
+IMPORT_MAX_FILE_SIZE = 1024 * 1024
+IMPORT_MAX_ERRORS = 20  # сколько ошибок показывать в ответе
+EXPORT_BATCH_SIZE = 500
+
+# Миграция и прогрев при старте: число потоков и запуск polling, не дожидаясь конца
+STARTUP_WORKERS = int(os.environ.get("STARTUP_WORKERS", "8"))
+MIGRATE_IN_BACKGROUND = os.environ.get("MIGRATE_IN_BACKGROUND") == "1"
+startup_failures = {}  # (chat_id, db_name) -> текст ошибки миграции
+
+# Кэш отрисованных страниц списка: (chat_id, db_name) -> {(вид, страница): (текст, клавиатура)}.
+# listing_epoch растёт при каждой инвалидации, чтобы не закэшировать страницу,
+# отрисованную до изменения списка.
+listing_cache = OrderedDict()
+listing_epoch = 0
+listing_lock = threading.Lock()
+
+# callback_data кнопок - 20 символов base64 независимо от длины названия списка:
+# код действия, 6 байт хэша названия и число (ID задачи или страница). Хэш
+# обратно в название переводит callback_lists: (chat_id, хэш) -> список, не больше
+# CALLBACK_CACHE_SIZE записей; промах заполняется из списков чата
+CALLBACK_CACHE_SIZE = int(os.environ.get("CALLBACK_CACHE_SIZE", "10000"))
+callback_lists = OrderedDict()
+callback_lock = threading.Lock()
+
+# Хранилище задач: "files" - отдельный .sqlite на каждый список в users_data/<chat_id>/,
+# "single" - все списки всех пользователей в одной базе STORAGE_DB_PATH
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "files")
+STORAGE_DB_PATH = os.environ.get("STORAGE_DB_PATH", "storage.sqlite")
+
+# Часовой пояс чата (/timezone) хранится в STATE_DB_PATH. DEFAULT_TIMEZONE - для чатов
+# без настройки и для задач, созданных до её появления
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "Europe/Moscow")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.sqlite")
+chat_timezones = {}  # chat_id -> название пояса
+
+# Незавершённые диалоги (бот ждёт ответа, например названия списка после /newproblemlist)
+# тоже лежат в STATE_DB_PATH: переживают перезапуск и общие для всех процессов бота.
+# Без ответа за NEXT_STEP_TTL секунд диалог забывается
+NEXT_STEP_TTL = int(os.environ.get("NEXT_STEP_TTL", "3600"))
+# Проверка "ждёт ли чат ответа" выполняется на каждое сообщение, поэтому идёт по
+# next_step_chats в памяти (загружается из БД при старте). NEXT_STEP_SHARED=1 - несколько
+# процессов бота делят STATE_DB_PATH (вебхук за балансировщиком): шаг мог задать другой
+# процесс, и проверка читает БД (в asyncio-режиме - в пуле потоков)
+NEXT_STEP_SHARED = os.environ.get("NEXT_STEP_SHARED") == "1"
+next_step_chats = {}  # chat_id -> expires_at шагов, заданных этим процессом или загруженных при старте
+
+# Архивация: подтверждённые задачи, чьё time_send старше ARCHIVE_AFTER_DAYS, и разовые
+# неподтверждённые старше EXPIRE_AFTER_DAYS (0 - не архивировать) переносятся в
+# ARCHIVE_DB_PATH раз в COMPACTION_INTERVAL секунд. Освободившееся место возвращается
+# только в БД, к которым не обращались COMPACTION_IDLE_SECONDS, порциями по
+# COMPACTION_VACUUM_PAGES страниц; файл без auto_vacuum=INCREMENTAL один раз
+# переводится на него полным VACUUM.
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB_PATH", "archive.sqlite")
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+EXPIRE_AFTER_DAYS = int(os.environ.get("EXPIRE_AFTER_DAYS", "0"))
+ARCHIVE_BATCH_SIZE = 500
+COMPACTION_INTERVAL = float(os.environ.get("COMPACTION_INTERVAL", str(6 * 3600)))
+COMPACTION_IDLE_SECONDS = float(os.environ.get("COMPACTION_IDLE_SECONDS", "300"))
+COMPACTION_MIN_FREE_PAGES = 256
+COMPACTION_VACUUM_PAGES = 1000
+compaction_report = {}  # chat_id (None - общий файл хранилища) -> (перенесено задач, освобождено байт)
+
+# Метрики и профилировщик: http://METRICS_HOST:METRICS_PORT/metrics (0 - не запускать).
+# Процесс напоминаний N отдаёт свои на METRICS_PORT + 1 + N. Профилировщик снимает
+# стеки всех потоков раз в PROFILE_INTERVAL секунд; включается POST /profile/start
+# (или PROFILE_ON_START=1), выключается POST /profile/stop, отчёт - GET /profile
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.01"))
+PROFILE_ON_START = os.environ.get("PROFILE_ON_START") == "1"
+
+# Очередь напоминаний в памяти: куча (due_at, chat_id, db_name, problem_id), due_at -
+# секунды UTC. due_index хранит актуальное due_at для каждой задачи: записи кучи,
+# которые с ним не совпадают (удалённые, подтверждённые, перенесённые), пропускаются.
+due_queue = []
+due_index = {}  # (chat_id, db_name) -> {problem_id: due_at}
+due_lock = threading.Lock()
+due_wakeup = threading.Condition(due_lock)  # будит поток напоминаний, если появилась более ранняя задача
+
+# В основном процессе при REMINDER_SHARDS > 0 изменения очереди уходят процессам
+# напоминаний через reminder_coordinator; в процессе напоминаний reminder_shard =
+# (номер, всего) - какие чаты он обслуживает
+reminder_coordinator = None
+reminder_shard = None
+
+# Обращения хранилища к файловой системе и к реестру списков - чтобы видеть,
+# что горячие обработчики обходятся без системных вызовов
+storage_counters = Counter()
+
+# Пул соединений с БД: ключ (для отдельных файлов - (chat_id, db_name)) -> запись пула,
+# в порядке LRU. Каждое соединение защищено своей блокировкой, поэтому его можно
+# делить между потоками обработчиков и потоком напоминаний.
+MAX_OPEN_CONNECTIONS = 256  # ограничение на число открытых файлов БД
+SQLITE_CACHE_KB = 2048
+open_connections = OrderedDict()
+pool_lock = threading.Lock()
 
 
-def create_user_folder(chat_id):
-    if not os.path.exists("users_data"):
-        os.mkdir("users_data")
-    user_folder = f"users_data/{chat_id}"
-    if not os.path.exists(user_folder):
-        os.mkdir(user_folder)
-    return user_folder
+def is_valid_db_name(name):
+    return bool(re.match(r'^[a-zA-Z0-9_]+$', name))
 
 
-def can_create_more_dbs(chat_id):
-    user_folder = create_user_folder(chat_id)
-    existing_dbs = [f for f in os.listdir(user_folder) if f.endswith('.sqlite')]
-    return len(existing_dbs) < MAX_DBS_PER_USER
+def apply_migrations(conn, migrations):
+    # Номер последней применённой миграции хранится в PRAGMA user_version.
+    # Каждый шаг - под BEGIN IMMEDIATE, чтобы процессы напоминаний, открывшие
+    # ту же БД одновременно, не применили его дважды.
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(migrations):
+            conn.rollback()
+            return
+        migrations[version](conn)
+        conn.execute(f"PRAGMA user_version = {version + 1}")
+        conn.commit()
 
 
-def is_valid_db_name(name):
-    return bool(re.match(r'^[a-zA-Z0-9_]+$', name))
+def open_db(db_path, migrations=(), create=True):
+    if create:
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+    else:
+        # Только существующий файл: обычный connect создал бы пустую БД на месте удалённой
+        conn = sqlite3.connect(f"file:{quote(db_path)}?mode=rw", uri=True, check_same_thread=False)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        apply_migrations(conn, migrations)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+def evict_idle_connections():
+    # Вызывается под pool_lock: закрываем самые давние неиспользуемые соединения
+    for key in list(open_connections):
+        if len(open_connections) <= MAX_OPEN_CONNECTIONS:
+            break
+        entry = open_connections[key]
+        if entry["users"] == 0:
+            del open_connections[key]
+            if entry["conn"] is not None:
+                entry["conn"].close()
+
+
+@contextmanager
+def db_connection(key, db_path, migrations=(), create=True):
+    with pool_lock:
+        entry = open_connections.get(key)
+        if entry is None:
+            entry = {
+                "conn": None,
+                "lock": threading.RLock(),
+                "users": 0,
+                "used": 0.0,
+            }
+            open_connections[key] = entry
+        open_connections.move_to_end(key)
+        entry["users"] += 1
+        evict_idle_connections()
 
+    try:
+        with entry["lock"]:
+            # Открываем и мигрируем под блокировкой самой БД, не задерживая остальные
+            if entry["conn"] is None:
+                entry["conn"] = open_db(db_path, migrations, create)
+            try:
+                yield entry["conn"]
+            except Exception:
+                entry["conn"].rollback()
+                raise
+    finally:
+        with pool_lock:
+            entry["users"] -= 1
+            entry["used"] = time.monotonic()
+
+
+def db_idle(key, idle_seconds):
+    # К БД никто не обращается хотя бы idle_seconds (не открытая - тоже простаивает)
+    with pool_lock:
+        entry = open_connections.get(key)
+        if entry is None:
+            return True
+        return entry["users"] == 0 and time.monotonic() - entry["used"] >= idle_seconds
+
+
+def vacuum_db(connect):
+    # Возвращает освободившееся место файлу, сколько байт. connect() - контекст
+    # соединения; между порциями incremental_vacuum блокировка БД отпускается
+    with connect() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+        if conn.execute("PRAGMA freelist_count").fetchone()[0] < COMPACTION_MIN_FREE_PAGES:
+            return 0
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.commit()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
 
-def create_db_if_not_exists(chat_id, db_name):
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
+    while True:
+        with connect() as conn:
+            conn.execute(f"PRAGMA incremental_vacuum({COMPACTION_VACUUM_PAGES})").fetchall()
+            if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                break
 
-    if os.path.exists(db_path):
-        return False
+    with connect() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return (pages_before - conn.execute("PRAGMA page_count").fetchone()[0]) * page_size
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
+
+@contextmanager
+def delivery_durability(conn):
+    # Режим synchronous только на время записи доставки, остальные записи - NORMAL
+    if DELIVERY_SYNCHRONOUS == "NORMAL":
+        yield
+        return
+
+    conn.execute(f"PRAGMA synchronous={DELIVERY_SYNCHRONOUS}")
+    try:
+        yield
+    finally:
+        # Внутри транзакции SQLite не меняет synchronous ("Safety level may not be
+        # changed inside a transaction"): незавершённую после ошибки запись откатываем
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Соединение из пула: остальные записи не должны унаследовать режим доставки
+        if conn.execute("PRAGMA synchronous").fetchone()[0] != 1:
+            report_error("delivery_flush", "Не удалось вернуть PRAGMA synchronous=NORMAL")
+
+
+def close_db_connection(key):
+    with pool_lock:
+        entry = open_connections.pop(key, None)
+    if entry is not None:
+        with entry["lock"]:
+            if entry["conn"] is not None:
+                entry["conn"].close()
+
+
+# Часовые пояса: название из pytz или смещение вида UTC+05:30
+TIMEZONE_OFFSET_RE = re.compile(r"^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+timezone_names = {name.lower(): name for name in pytz.all_timezones}
+
+
+def parse_timezone(text):
+    # Текст пользователя -> каноническое название пояса; ValueError, если не разобрать
+    text = text.strip()
+    match = TIMEZONE_OFFSET_RE.match(text)
+    if match:
+        sign, hours, minutes = match.group(1), int(match.group(2)), int(match.group(3) or 0)
+        if hours > 14 or minutes > 59:
+            raise ValueError(f"Смещение {text} вне диапазона -14:00..+14:00!")
+        return f"UTC{sign}{hours:02d}:{minutes:02d}"
+    name = timezone_names.get(text.lower())
+    if name is None:
+        raise ValueError(f"Неизвестный часовой пояс {text}! Пример: Europe/Moscow, Asia/Almaty или +3")
+    return name
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    match = TIMEZONE_OFFSET_RE.match(name)
+    if match:
+        offset = int(match.group(2)) * 60 + int(match.group(3) or 0)
+        return pytz.FixedOffset(-offset if match.group(1) == "-" else offset)
+    return pytz.timezone(name)
+
+
+def local_now(tz):
+    return datetime.now(tz).replace(tzinfo=None)
+
+
+def local_epoch(time_str, tz):
+    # "ГГГГ-ММ-ДД чч:мм:сс" в поясе tz -> секунды UTC
+    return int(tz.localize(datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")).timestamp())
+
+
+def sql_local_epoch(conn, tz):
+    # Функция to_epoch(строка) для UPDATE по всей таблице; NULL для пустых и битых значений
+    def to_epoch(value):
+        try:
+            return local_epoch(value, tz)
+        except (TypeError, ValueError):
+            return None
+
+    conn.create_function("to_epoch", 1, to_epoch)
+
+
+# Миграции схемы. Каждая выполняется один раз при первом открытии БД, номер
+# последней применённой хранится в PRAGMA user_version. Новые шаги - только в конец.
+def migrate_create_problems(conn):
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS problems (
             problem_id INTEGER PRIMARY KEY AUTOINCREMENT,
             problem TEXT NOT NULL,
@@ -51,72 +398,1554 @@ def create_db_if_not_exists(chat_id, db_name):
             last_notification DATETIME  
         )"""
     )
-    conn.commit()
-    conn.close()
-    return True
 
+    # Базы, созданные до появления напоминаний, без этих столбцов
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(problems)").fetchall()]
+    if "confirmed" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN confirmed BOOLEAN DEFAULT FALSE")
+    if "last_notification" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN last_notification DATETIME")
 
 
-def get_user_dbs(chat_id):
-    user_folder = create_user_folder(chat_id)
-    return [f for f in os.listdir(user_folder) if f.endswith('.sqlite')]
+def migrate_create_single_file(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS lists (
+            chat_id INTEGER NOT NULL,
+            list_name TEXT NOT NULL,
+            PRIMARY KEY (chat_id, list_name)
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS problems (
+            problem_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            list_name TEXT NOT NULL,
+            problem TEXT NOT NULL,
+            time_create DATETIME DEFAULT CURRENT_TIMESTAMP,
+            time_send DATETIME NOT NULL,
+            confirmed BOOLEAN DEFAULT FALSE,
+            last_notification DATETIME
+        )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_problems_list ON problems (chat_id, list_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_problems_due ON problems (confirmed, time_send)")
 
 
-def add_problem_to_db(chat_id, db_name, problem, time_send):
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
+def migrate_pending_index(conn):
+    # Частичный индекс только по неподтверждённым задачам: выборка наступивших
+    # (confirmed = FALSE AND time_send <= ?) не зависит от числа выполненных
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_problems_pending
+           ON problems (time_send, last_notification) WHERE confirmed = FALSE"""
+    )
 
-    if not os.path.exists(db_path):
-        return False
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO problems (problem, time_send) VALUES (?, ?)",
-        (problem, time_send)
+def migrate_single_file_pending_index(conn):
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_problems_pending
+           ON problems (chat_id, list_name, time_send) WHERE confirmed = FALSE"""
+    )
+
+
+def migrate_recurrence(conn):
+    # Правило повторения (NULL - разовая задача), см. parse_recurrence
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(problems)").fetchall()]
+    if "recurrence" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN recurrence TEXT")
+
+
+def migrate_due_at(conn):
+    # due_at и notified_at - time_send и last_notification в секундах UTC: планировщик
+    # сравнивает числа, без разбора строк. Существующие задачи - в поясе по умолчанию
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(problems)").fetchall()]
+    if "due_at" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN due_at INTEGER")
+    if "notified_at" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN notified_at INTEGER")
+
+    sql_local_epoch(conn, get_timezone(DEFAULT_TIMEZONE))
+    conn.execute("UPDATE problems SET due_at = to_epoch(time_send), notified_at = to_epoch(last_notification)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_problems_due_at ON problems (due_at) WHERE confirmed = FALSE")
+
+
+def migrate_notify_count(conn):
+    # Сколько напоминаний о текущем срабатывании уже доставлено - от него растёт пауза
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(problems)").fetchall()]
+    if "notify_count" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN notify_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE problems SET notify_count = 1 WHERE notified_at IS NOT NULL")
+
+
+def migrate_delivery_lease(conn):
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(problems)").fetchall()]
+    if "lease_owner" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN lease_owner TEXT")
+    if "lease_until" not in columns:
+        conn.execute("ALTER TABLE problems ADD COLUMN lease_until INTEGER")
+
+
+def migrate_archive_index(conn):
+    # Индекс для archivable_tasks: idx_problems_due_at частичный и подтверждённые
+    # задачи (confirmed = TRUE AND due_at < ?) не покрывает
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_problems_archive ON problems (confirmed, due_at)")
+
+
+def migrate_single_file_archive_index(conn):
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_problems_archive
+           ON problems (chat_id, list_name, confirmed, due_at)"""
+    )
+
+
+def migrate_drop_unused_indexes(conn):
+    # После перехода на due_at выборки неподтверждённых и наступивших задач идут по
+    # idx_problems_archive, а индексы по time_send и частичный по due_at только
+    # замедляют каждую запись (в том числе last_notification после доставки)
+    for index in ("idx_problems_pending", "idx_problems_due", "idx_problems_due_at"):
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+
+
+FILE_MIGRATIONS = [
+    migrate_create_problems,  # 1
+    migrate_pending_index,  # 2
+    migrate_recurrence,  # 3
+    migrate_due_at,  # 4
+    migrate_notify_count,  # 5
+    migrate_delivery_lease,  # 6
+    migrate_archive_index,  # 7
+    migrate_drop_unused_indexes,  # 8
+]
+
+SINGLE_FILE_MIGRATIONS = [
+    migrate_create_single_file,  # 1
+    migrate_single_file_pending_index,  # 2
+    migrate_recurrence,  # 3
+    migrate_due_at,  # 4
+    migrate_notify_count,  # 5
+    migrate_delivery_lease,  # 6
+    migrate_single_file_archive_index,  # 7
+    migrate_drop_unused_indexes,  # 8
+]
+
+
+def migrate_create_chat_settings(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL
+        )"""
+    )
+
+
+def migrate_create_pending_steps(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS pending_steps (
+            chat_id INTEGER PRIMARY KEY,
+            step TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_steps_expires ON pending_steps(expires_at)")
+
+
+STATE_MIGRATIONS = [
+    migrate_create_chat_settings,  # 1
+    migrate_create_pending_steps,  # 2
+]
+
+
+def migrate_create_archive(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS problems_archive (
+            chat_id INTEGER NOT NULL,
+            list_name TEXT NOT NULL,
+            problem_id INTEGER NOT NULL,
+            problem TEXT NOT NULL,
+            time_create DATETIME,
+            time_send DATETIME NOT NULL,
+            confirmed BOOLEAN,
+            last_notification DATETIME,
+            recurrence TEXT,
+            time_archived DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, list_name, problem_id, time_create)
+        )"""
     )
-    conn.commit()
-    conn.close()
+
+
+ARCHIVE_MIGRATIONS = [
+    migrate_create_archive,  # 1
+]
+
+
+# Метрики в формате Prometheus: счётчики и гистограммы времени по имени и меткам.
+# Отдаются на METRICS_HOST:METRICS_PORT/metrics, там же включается профилировщик.
+class Histogram:
+    # Гистограмма с фиксированными границами корзин (в секундах)
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина - больше всех границ
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            index = 0
+            while index < len(self.bounds) and value > self.bounds[index]:
+                index += 1
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Верхняя граница корзины, в которую попадает квантиль q
+        with self.lock:
+            if not self.count:
+                return None
+            seen = 0
+            for bound, count in zip(self.bounds + [float("inf")], self.counts):
+                seen += count
+                if seen >= q * self.count:
+                    return bound
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.total, self.count
+
+
+LATENCY_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+metric_counters = Counter()  # (имя, метки) -> значение
+metric_histograms = {}  # (имя, метки) -> Histogram
+metrics_lock = threading.Lock()
+
+
+def count_metric(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] += value
+
+
+def observe_metric(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metric_histograms.get(key)
+        if histogram is None:
+            histogram = metric_histograms[key] = Histogram(LATENCY_BOUNDS)
+    histogram.observe(value)
+
+
+@contextmanager
+def timed(name, **labels):
+    # name_seconds - время блока, name_errors_total - вылетевшие из него исключения
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count_metric(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        observe_metric(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+
+def instrumented(name, function, **labels):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timed(name, **labels):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def instrumented_generator(name, function, **labels):
+    # Генератор замеряем за всю итерацию: суммируем время внутри него по всем
+    # элементам, без времени потребителя между ними; одно наблюдение на вызов
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        iterator = function(*args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                except Exception:
+                    count_metric(f"{name}_errors_total", **labels)
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            iterator.close()
+            observe_metric(f"{name}_seconds", elapsed, **labels)
+    return wrapper
+
+
+def report_error(where, message):
+    count_metric("errors_total", where=where)
+    print(message)
+
+
+class InstrumentedStorage:
+    # Хранилище с замером каждого метода: storage_seconds{method="..."}
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if inspect.isgeneratorfunction(attr):
+            attr = instrumented_generator("storage", attr, method=name)
+        elif callable(attr):
+            attr = instrumented("storage", attr, method=name)
+        setattr(self, name, attr)
+        return attr
+
+
+class ListRegistry:
+    # Известные пользователи и их списки. Загружается из хранилища один раз,
+    # дальше обновляется при создании и удалении списков, так что горячие
+    # обработчики не обращаются ни к файловой системе, ни к БД.
+
+    def __init__(self, load):
+        self.load = load  # -> [(chat_id, list_name), ...]
+        self.lists = None  # chat_id -> set(list_name)
+        self.lock = threading.Lock()
+
+    def loaded(self):
+        # Вызывается под self.lock
+        if self.lists is None:
+            lists = {}
+            for chat_id, list_name in self.load():
+                lists.setdefault(chat_id, set()).add(list_name)
+            self.lists = lists
+        return self.lists
+
+    def has_user(self, chat_id):
+        with self.lock:
+            storage_counters["registry_lookups"] += 1
+            return chat_id in self.loaded()
+
+    def add_user(self, chat_id):
+        with self.lock:
+            self.loaded().setdefault(chat_id, set())
+
+    def names(self, chat_id):
+        with self.lock:
+            storage_counters["registry_lookups"] += 1
+            return sorted(self.loaded().get(chat_id, ()))
+
+    def contains(self, chat_id, list_name):
+        with self.lock:
+            storage_counters["registry_lookups"] += 1
+            return list_name in self.loaded().get(chat_id, ())
+
+    def add(self, chat_id, list_name):
+        # False, если список уже есть: так создание одного имени из двух потоков не гонится
+        with self.lock:
+            names = self.loaded().setdefault(chat_id, set())
+            if list_name in names:
+                return False
+            names.add(list_name)
+            return True
+
+    def remove(self, chat_id, list_name):
+        with self.lock:
+            self.loaded().get(chat_id, set()).discard(list_name)
+
+    def all(self):
+        with self.lock:
+            return [(chat_id, name) for chat_id, names in self.loaded().items() for name in sorted(names)]
+
+
+class FileStorage:
+    # Отдельная SQLite-база на каждый список: users_data/<chat_id>/<list_name>.sqlite
+
+    def __init__(self, root="users_data"):
+        self.root = root
+        self.registry = ListRegistry(self.scan_lists)
+
+    def scan_lists(self):
+        # Единственный полный обход users_data - при заполнении реестра
+        storage_counters["fs_exists"] += 1
+        if not os.path.exists(self.root):
+            return []
+
+        lists = []
+        storage_counters["fs_listdir"] += 1
+        for user_folder in os.listdir(self.root):
+            if not user_folder.isdigit():
+                continue
+            storage_counters["fs_listdir"] += 1
+            for db_file in os.listdir(f"{self.root}/{user_folder}"):
+                if db_file.endswith(".sqlite"):
+                    lists.append((int(user_folder), db_file[:-len(".sqlite")]))
+        return lists
+
+    def user_folder(self, chat_id):
+        user_folder = f"{self.root}/{chat_id}"
+        if self.registry.has_user(chat_id):
+            return user_folder
+
+        storage_counters["fs_exists"] += 2
+        if not os.path.exists(self.root):
+            storage_counters["fs_mkdir"] += 1
+            os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(user_folder):
+            storage_counters["fs_mkdir"] += 1
+            os.makedirs(user_folder, exist_ok=True)
+        self.registry.add_user(chat_id)
+        return user_folder
+
+    def db_path(self, chat_id, list_name):
+        return f"{self.root}/{chat_id}/{list_name}.sqlite"
+
+    def connection(self, chat_id, list_name, create=False):
+        # Файл создаёт только create_list: обращение к удалённому списку (проход
+        # напоминаний, сжатие) не должно вернуть его на диск
+        return db_connection((chat_id, list_name), self.db_path(chat_id, list_name), FILE_MIGRATIONS, create)
+
+    def user_location(self, chat_id):
+        return self.user_folder(chat_id)
+
+    def list_names(self, chat_id):
+        return self.registry.names(chat_id)
+
+    def list_exists(self, chat_id, list_name):
+        return self.registry.contains(chat_id, list_name)
+
+    def iter_lists(self):
+        return self.registry.all()
+
+    def create_list(self, chat_id, list_name):
+        self.user_folder(chat_id)
+        if not self.registry.add(chat_id, list_name):
+            return False
+
+        # Таблицу создаёт первая миграция при открытии нового файла
+        try:
+            with self.connection(chat_id, list_name, create=True):
+                pass
+        except Exception:
+            self.registry.remove(chat_id, list_name)
+            raise
+        return True
+
+    def migrate_list(self, chat_id, list_name):
+        # Миграции применяются при первом открытии
+        with self.connection(chat_id, list_name):
+            pass
+
+    def remember_list(self, chat_id, list_name):
+        # Список создан другим процессом
+        self.registry.add(chat_id, list_name)
+
+    def forget_list(self, chat_id, list_name):
+        # Список удалён другим процессом: соединение держит уже удалённый файл
+        close_db_connection((chat_id, list_name))
+        self.registry.remove(chat_id, list_name)
+
+    def delete_list(self, chat_id, list_name):
+        if not self.registry.contains(chat_id, list_name):
+            return False
+
+        db_path = self.db_path(chat_id, list_name)
+        close_db_connection((chat_id, list_name))
+        self.registry.remove(chat_id, list_name)
+        for suffix in ("", "-wal", "-shm"):
+            storage_counters["fs_remove"] += 1
+            try:
+                os.remove(db_path + suffix)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def add_problem(self, chat_id, list_name, problem, time_send, due_at, recurrence=None):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO problems (problem, time_send, due_at, recurrence) VALUES (?, ?, ?, ?)",
+                (problem, time_send, due_at, recurrence)
+            )
+            conn.commit()
+            return cursor.lastrowid
+
+    def add_problems(self, chat_id, list_name, problems):
+        # problems: [(задача, time_send, due_at, правило)] - одна транзакция; возвращает [(problem_id, due_at)]
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection(chat_id, list_name) as conn:
+            last_id = conn.execute("SELECT COALESCE(MAX(problem_id), 0) FROM problems").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO problems (problem, time_send, due_at, recurrence) VALUES (?, ?, ?, ?)", problems
+            )
+            added = conn.execute(
+                "SELECT problem_id, due_at FROM problems WHERE problem_id > ? ORDER BY problem_id",
+                (last_id,)
+            ).fetchall()
+            conn.commit()
+            return added
+
+    def iter_problems(self, chat_id, list_name, batch_size):
+        # Все задачи списка порциями по batch_size, соединение держим только на время порции
+        last_id = 0
+        while True:
+            with self.connection(chat_id, list_name) as conn:
+                rows = conn.execute(
+                    """SELECT problem_id, problem, time_create, time_send, confirmed, last_notification,
+                       recurrence FROM problems WHERE problem_id > ? ORDER BY problem_id LIMIT ?""",
+                    (last_id, batch_size)
+                ).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def get_problems(self, chat_id, list_name):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT problem_id, problem, time_create, time_send FROM problems")
+            return cursor.fetchall()
+
+    def get_problems_page(self, chat_id, list_name, limit, offset):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.execute(
+                """SELECT problem_id, problem, time_create, time_send, recurrence FROM problems
+                   ORDER BY problem_id LIMIT ? OFFSET ?""",
+                (limit, offset)
+            )
+            return cursor.fetchall()
+
+    def count_problems(self, chat_id, list_name):
+        if not self.list_exists(chat_id, list_name):
+            return 0
+
+        with self.connection(chat_id, list_name) as conn:
+            return conn.execute("SELECT COUNT(*) FROM problems").fetchone()[0]
+
+    def delete_problem(self, chat_id, list_name, problem_id):
+        if not self.list_exists(chat_id, list_name):
+            return False
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM problems WHERE problem_id = ?",
+                (problem_id,)
+            )
+            conn.commit()
+        return True
+
+    def confirm_task(self, chat_id, list_name, task_id):
+        if not self.list_exists(chat_id, list_name):
+            return False
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE problems SET confirmed = TRUE WHERE problem_id = ?",
+                (task_id,)
+            )
+            conn.commit()
+        return True
+
+    def advance_task(self, chat_id, list_name, task_id, tz):
+        # Повторяющаяся задача вместо подтверждения переходит к следующему срабатыванию
+        # (по времени пояса tz). Возвращает новое due_at или None, если задача разовая.
+        # Кнопка подтверждения приходит только с наступившей задачей, так что due_at в
+        # будущем значит: срабатывание уже подтверждено, нажата кнопка старого напоминания
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection(chat_id, list_name) as conn:
+            row = conn.execute(
+                "SELECT recurrence, time_send, due_at FROM problems WHERE problem_id = ? AND confirmed = FALSE",
+                (task_id,)
+            ).fetchone()
+            if row is None or row[0] is None:
+                return None
+            if row[2] is not None and row[2] > time.time():
+                return row[2]
+            next_time = advance_time_send(row[0], row[1], local_now(tz))
+            due_at = local_epoch(next_time, tz)
+            conn.execute(
+                """UPDATE problems SET time_send = ?, due_at = ?, last_notification = NULL, notified_at = NULL,
+                   notify_count = 0, lease_owner = NULL, lease_until = NULL WHERE problem_id = ?""",
+                (next_time, due_at, task_id)
+            )
+            conn.commit()
+            return due_at
+
+    def update_due_times(self, chat_id, list_name, tz):
+        # Пересчёт due_at после смены часового пояса чата
+        with self.connection(chat_id, list_name) as conn:
+            sql_local_epoch(conn, tz)
+            conn.execute("UPDATE problems SET due_at = to_epoch(time_send)")
+            conn.commit()
+
+    def archivable_tasks(self, chat_id, list_name, confirmed_before, expired_before, limit):
+        # Подтверждённые задачи с due_at раньше confirmed_before и разовые
+        # неподтверждённые раньше expired_before (0 - никакие). Две ветки через
+        # UNION ALL, чтобы каждая шла по idx_problems_archive, а не сканом таблицы
+        with self.connection(chat_id, list_name) as conn:
+            return conn.execute(
+                """SELECT problem_id, problem, time_create, time_send, confirmed, last_notification, recurrence
+                   FROM problems WHERE confirmed = TRUE AND due_at < ?
+                   UNION ALL
+                   SELECT problem_id, problem, time_create, time_send, confirmed, last_notification, recurrence
+                   FROM problems WHERE confirmed = FALSE AND recurrence IS NULL AND due_at < ?
+                   ORDER BY problem_id LIMIT ?""",
+                (confirmed_before, expired_before, limit)
+            ).fetchall()
+
+    def delete_tasks(self, chat_id, list_name, task_ids):
+        with self.connection(chat_id, list_name) as conn:
+            conn.executemany("DELETE FROM problems WHERE problem_id = ?", [(task_id,) for task_id in task_ids])
+            conn.commit()
+
+    def pool_key(self, chat_id, list_name):
+        return (chat_id, list_name)
+
+    def vacuum(self, chat_id, list_name):
+        return vacuum_db(lambda: self.connection(chat_id, list_name))
+
+    def pending_tasks(self, chat_id, list_name):
+        # (problem_id, due_at, notified_at, notify_count, lease_until) неподтверждённых задач списка
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT problem_id, due_at, notified_at, notify_count, lease_until
+                   FROM problems WHERE confirmed = FALSE"""
+            )
+            return cursor.fetchall()
+
+    def unconfirmed_tasks(self, chat_id, list_name, task_ids):
+        # Список удалён, пока задачи ждали в очереди, - их просто нет
+        if not self.list_exists(chat_id, list_name):
+            return []
+
+        with self.connection(chat_id, list_name) as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(task_ids))
+            cursor.execute(
+                f"""SELECT problem_id, problem, time_send, due_at, notified_at, notify_count, lease_until 
+                   FROM problems 
+                   WHERE confirmed = FALSE AND problem_id IN ({placeholders})""",
+                list(task_ids)
+            )
+            return cursor.fetchall()
+
+    def overdue_tasks(self, chat_id, list_name, now):
+        # Неподтверждённые задачи с наступившим временем, для дайджеста
+        if not self.list_exists(chat_id, list_name):
+            return []
+
+        with self.connection(chat_id, list_name) as conn:
+            return conn.execute(
+                """SELECT problem_id, problem, time_send, notify_count, notified_at, lease_until FROM problems
+                   WHERE confirmed = FALSE AND (due_at IS NULL OR due_at <= ?)
+                   ORDER BY due_at, problem_id""",
+                (now,)
+            ).fetchall()
+
+    def claim_tasks(self, chat_id, list_name, claims, owner, now, lease_until):
+        # claims: [(task_id, notified_at), ...]. Задача достаётся, только если её аренда
+        # свободна или истекла и о ней не напомнили после чтения (notified_at тот же).
+        # Возвращает ID закреплённых задач
+        if not self.list_exists(chat_id, list_name):
+            return []
+
+        claimed = []
+        with self.connection(chat_id, list_name) as conn:
+            for task_id, notified_at in claims:
+                cursor = conn.execute(
+                    """UPDATE problems SET lease_owner = ?, lease_until = ?
+                       WHERE problem_id = ? AND confirmed = FALSE AND notified_at IS ?
+                         AND (lease_until IS NULL OR lease_until <= ?)""",
+                    (owner, lease_until, task_id, notified_at, now)
+                )
+                if cursor.rowcount:
+                    claimed.append(task_id)
+            conn.commit()
+        return claimed
+
+    def extend_leases(self, chat_id, list_name, task_ids, owner, lease_until):
+        # Продлевает свою аренду; возвращает ID задач, аренда которых ещё своя
+        if not self.list_exists(chat_id, list_name):
+            return []
+
+        extended = []
+        with self.connection(chat_id, list_name) as conn:
+            for task_id in task_ids:
+                cursor = conn.execute(
+                    "UPDATE problems SET lease_until = ? WHERE problem_id = ? AND lease_owner = ?",
+                    (lease_until, task_id, owner)
+                )
+                if cursor.rowcount:
+                    extended.append(task_id)
+            conn.commit()
+        return extended
+
+    def release_leases(self, released, owner):
+        # released: [(chat_id, list_name, task_id), ...] - задачи, которые не удалось отправить
+        by_list = {}
+        for chat_id, list_name, task_id in released:
+            by_list.setdefault((chat_id, list_name), []).append((task_id, owner))
+
+        for (chat_id, list_name), rows in by_list.items():
+            if not self.list_exists(chat_id, list_name):
+                continue
+            with self.connection(chat_id, list_name) as conn:
+                conn.executemany(
+                    "UPDATE problems SET lease_owner = NULL, lease_until = NULL WHERE problem_id = ? AND lease_owner = ?",
+                    rows
+                )
+                conn.commit()
+
+    def mark_notified_batch(self, delivered, owner):
+        # delivered: [(chat_id, list_name, task_id, notified_at), ...] - одна транзакция на список.
+        # Запись снимает аренду и проходит, только пока аренда своя; возвращает число записанных
+        by_list = {}
+        for chat_id, list_name, task_id, notified_at in delivered:
+            by_list.setdefault((chat_id, list_name), []).append(
+                (notification_time_str(notified_at), notified_at, task_id, owner)
+            )
+
+        marked = 0
+        for (chat_id, list_name), rows in by_list.items():
+            if not self.list_exists(chat_id, list_name):
+                continue
+            try:
+                with self.connection(chat_id, list_name) as conn, delivery_durability(conn):
+                    marked += conn.executemany(
+                        """UPDATE problems SET last_notification = ?, notified_at = ?, notify_count = notify_count + 1,
+                           lease_owner = NULL, lease_until = NULL
+                           WHERE problem_id = ? AND lease_owner = ?""",
+                        rows
+                    ).rowcount
+                    conn.commit()
+            except Exception as e:
+                report_error("delivery_flush", f"Ошибка записи доставки в БД {list_name}: {e}")
+        return marked
+
+
+class SingleFileStorage:
+    # Все списки всех пользователей в одной SQLite-базе со столбцами (chat_id, list_name)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.registry = ListRegistry(self.scan_lists)
+        # Общая база одна - мигрируем сразу
+        with self.connection():
+            pass
+
+    def connection(self):
+        return db_connection((None, self.db_path), self.db_path, SINGLE_FILE_MIGRATIONS)
+
+    def user_location(self, chat_id):
+        return f"{self.db_path} (chat_id = {chat_id})"
+
+    def scan_lists(self):
+        with self.connection() as conn:
+            return conn.execute("SELECT chat_id, list_name FROM lists").fetchall()
+
+    def list_names(self, chat_id):
+        return self.registry.names(chat_id)
+
+    def list_exists(self, chat_id, list_name):
+        return self.registry.contains(chat_id, list_name)
+
+    def iter_lists(self):
+        return self.registry.all()
+
+    def create_list(self, chat_id, list_name):
+        if not self.registry.add(chat_id, list_name):
+            return False
+
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO lists (chat_id, list_name) VALUES (?, ?)", (chat_id, list_name)
+                )
+                conn.commit()
+        except Exception:
+            self.registry.remove(chat_id, list_name)
+            raise
+        return True
+
+    def migrate_list(self, chat_id, list_name):
+        # Общая база мигрирована при открытии хранилища
+        pass
+
+    def remember_list(self, chat_id, list_name):
+        self.registry.add(chat_id, list_name)
+
+    def forget_list(self, chat_id, list_name):
+        self.registry.remove(chat_id, list_name)
+
+    def delete_list(self, chat_id, list_name):
+        if not self.registry.contains(chat_id, list_name):
+            return False
+
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM problems WHERE chat_id = ? AND list_name = ?", (chat_id, list_name)
+            )
+            conn.execute(
+                "DELETE FROM lists WHERE chat_id = ? AND list_name = ?", (chat_id, list_name)
+            )
+            conn.commit()
+        self.registry.remove(chat_id, list_name)
+        return True
+
+    def add_problem(self, chat_id, list_name, problem, time_send, due_at, recurrence=None):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection() as conn:
+            cursor = conn.execute(
+                """INSERT INTO problems (chat_id, list_name, problem, time_send, due_at, recurrence)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (chat_id, list_name, problem, time_send, due_at, recurrence)
+            )
+            conn.commit()
+            return cursor.lastrowid
+
+    def add_problems(self, chat_id, list_name, problems):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection() as conn:
+            last_id = conn.execute("SELECT COALESCE(MAX(problem_id), 0) FROM problems").fetchone()[0]
+            conn.executemany(
+                """INSERT INTO problems (chat_id, list_name, problem, time_send, due_at, recurrence)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(chat_id, list_name, *problem) for problem in problems]
+            )
+            added = conn.execute(
+                """SELECT problem_id, due_at FROM problems
+                   WHERE chat_id = ? AND list_name = ? AND problem_id > ? ORDER BY problem_id""",
+                (chat_id, list_name, last_id)
+            ).fetchall()
+            conn.commit()
+            return added
+
+    def iter_problems(self, chat_id, list_name, batch_size):
+        last_id = 0
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute(
+                    """SELECT problem_id, problem, time_create, time_send, confirmed, last_notification,
+                       recurrence FROM problems WHERE chat_id = ? AND list_name = ? AND problem_id > ?
+                       ORDER BY problem_id LIMIT ?""",
+                    (chat_id, list_name, last_id, batch_size)
+                ).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def get_problems(self, chat_id, list_name):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection() as conn:
+            cursor = conn.execute(
+                """SELECT problem_id, problem, time_create, time_send FROM problems
+                   WHERE chat_id = ? AND list_name = ?""",
+                (chat_id, list_name)
+            )
+            return cursor.fetchall()
+
+    def get_problems_page(self, chat_id, list_name, limit, offset):
+        if not self.list_exists(chat_id, list_name):
+            return None
+
+        with self.connection() as conn:
+            cursor = conn.execute(
+                """SELECT problem_id, problem, time_create, time_send, recurrence FROM problems
+                   WHERE chat_id = ? AND list_name = ?
+                   ORDER BY problem_id LIMIT ? OFFSET ?""",
+                (chat_id, list_name, limit, offset)
+            )
+            return cursor.fetchall()
+
+    def count_problems(self, chat_id, list_name):
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM problems WHERE chat_id = ? AND list_name = ?",
+                (chat_id, list_name)
+            ).fetchone()[0]
+
+    def delete_problem(self, chat_id, list_name, problem_id):
+        if not self.list_exists(chat_id, list_name):
+            return False
+
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM problems WHERE problem_id = ? AND chat_id = ? AND list_name = ?",
+                (problem_id, chat_id, list_name)
+            )
+            conn.commit()
+        return True
+
+    def confirm_task(self, chat_id, list_name, task_id):
+        if not self.list_exists(chat_id, list_name):
+            return False
+
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE problems SET confirmed = TRUE WHERE problem_id = ? AND chat_id = ? AND list_name = ?",
+                (task_id, chat_id, list_name)
+            )
+            conn.commit()
+        return True
+
+    def advance_task(self, chat_id, list_name, task_id, tz):
+        with self.connection() as conn:
+            row = conn.execute(
+                """SELECT recurrence, time_send, due_at FROM problems
+                   WHERE problem_id = ? AND chat_id = ? AND list_name = ? AND confirmed = FALSE""",
+                (task_id, chat_id, list_name)
+            ).fetchone()
+            if row is None or row[0] is None:
+                return None
+            if row[2] is not None and row[2] > time.time():
+                return row[2]
+            next_time = advance_time_send(row[0], row[1], local_now(tz))
+            due_at = local_epoch(next_time, tz)
+            conn.execute(
+                """UPDATE problems SET time_send = ?, due_at = ?, last_notification = NULL, notified_at = NULL,
+                   notify_count = 0, lease_owner = NULL, lease_until = NULL WHERE problem_id = ?""",
+                (next_time, due_at, task_id)
+            )
+            conn.commit()
+            return due_at
+
+    def update_due_times(self, chat_id, list_name, tz):
+        with self.connection() as conn:
+            sql_local_epoch(conn, tz)
+            conn.execute(
+                "UPDATE problems SET due_at = to_epoch(time_send) WHERE chat_id = ? AND list_name = ?",
+                (chat_id, list_name)
+            )
+            conn.commit()
+
+    def archivable_tasks(self, chat_id, list_name, confirmed_before, expired_before, limit):
+        with self.connection() as conn:
+            return conn.execute(
+                """SELECT problem_id, problem, time_create, time_send, confirmed, last_notification, recurrence
+                   FROM problems
+                   WHERE chat_id = ? AND list_name = ? AND confirmed = TRUE AND due_at < ?
+                   UNION ALL
+                   SELECT problem_id, problem, time_create, time_send, confirmed, last_notification, recurrence
+                   FROM problems
+                   WHERE chat_id = ? AND list_name = ? AND confirmed = FALSE AND recurrence IS NULL AND due_at < ?
+                   ORDER BY problem_id LIMIT ?""",
+                (chat_id, list_name, confirmed_before, chat_id, list_name, expired_before, limit)
+            ).fetchall()
+
+    def delete_tasks(self, chat_id, list_name, task_ids):
+        with self.connection() as conn:
+            conn.executemany(
+                "DELETE FROM problems WHERE problem_id = ? AND chat_id = ? AND list_name = ?",
+                [(task_id, chat_id, list_name) for task_id in task_ids]
+            )
+            conn.commit()
+
+    def pool_key(self, chat_id, list_name):
+        return (None, self.db_path)
+
+    def vacuum(self, chat_id, list_name):
+        # Файл общий для всех: очищается целиком, место не делится по пользователям
+        return vacuum_db(self.connection)
+
+    def pending_tasks(self, chat_id, list_name):
+        with self.connection() as conn:
+            cursor = conn.execute(
+                """SELECT problem_id, due_at, notified_at, notify_count, lease_until FROM problems
+                   WHERE confirmed = FALSE AND chat_id = ? AND list_name = ?""",
+                (chat_id, list_name)
+            )
+            return cursor.fetchall()
+
+    def unconfirmed_tasks(self, chat_id, list_name, task_ids):
+        with self.connection() as conn:
+            placeholders = ",".join("?" * len(task_ids))
+            cursor = conn.execute(
+                f"""SELECT problem_id, problem, time_send, due_at, notified_at, notify_count, lease_until
+                   FROM problems
+                   WHERE confirmed = FALSE AND chat_id = ? AND list_name = ?
+                   AND problem_id IN ({placeholders})""",
+                [chat_id, list_name, *task_ids]
+            )
+            return cursor.fetchall()
+
+    def overdue_tasks(self, chat_id, list_name, now):
+        with self.connection() as conn:
+            return conn.execute(
+                """SELECT problem_id, problem, time_send, notify_count, notified_at, lease_until FROM problems
+                   WHERE confirmed = FALSE AND chat_id = ? AND list_name = ?
+                     AND (due_at IS NULL OR due_at <= ?)
+                   ORDER BY due_at, problem_id""",
+                (chat_id, list_name, now)
+            ).fetchall()
+
+    def claim_tasks(self, chat_id, list_name, claims, owner, now, lease_until):
+        claimed = []
+        with self.connection() as conn:
+            for task_id, notified_at in claims:
+                cursor = conn.execute(
+                    """UPDATE problems SET lease_owner = ?, lease_until = ?
+                       WHERE problem_id = ? AND chat_id = ? AND list_name = ? AND confirmed = FALSE
+                         AND notified_at IS ? AND (lease_until IS NULL OR lease_until <= ?)""",
+                    (owner, lease_until, task_id, chat_id, list_name, notified_at, now)
+                )
+                if cursor.rowcount:
+                    claimed.append(task_id)
+            conn.commit()
+        return claimed
+
+    def extend_leases(self, chat_id, list_name, task_ids, owner, lease_until):
+        extended = []
+        with self.connection() as conn:
+            for task_id in task_ids:
+                cursor = conn.execute(
+                    """UPDATE problems SET lease_until = ?
+                       WHERE problem_id = ? AND chat_id = ? AND list_name = ? AND lease_owner = ?""",
+                    (lease_until, task_id, chat_id, list_name, owner)
+                )
+                if cursor.rowcount:
+                    extended.append(task_id)
+            conn.commit()
+        return extended
+
+    def release_leases(self, released, owner):
+        with self.connection() as conn:
+            conn.executemany(
+                """UPDATE problems SET lease_owner = NULL, lease_until = NULL
+                   WHERE problem_id = ? AND chat_id = ? AND list_name = ? AND lease_owner = ?""",
+                [(task_id, chat_id, list_name, owner) for chat_id, list_name, task_id in released]
+            )
+            conn.commit()
+
+    def mark_notified_batch(self, delivered, owner):
+        # Все списки в одной базе - вся пачка одной транзакцией
+        with self.connection() as conn, delivery_durability(conn):
+            marked = conn.executemany(
+                """UPDATE problems SET last_notification = ?, notified_at = ?, notify_count = notify_count + 1,
+                   lease_owner = NULL, lease_until = NULL
+                   WHERE problem_id = ? AND chat_id = ? AND lease_owner = ?""",
+                [
+                    (notification_time_str(notified_at), notified_at, task_id, chat_id, owner)
+                    for chat_id, _, task_id, notified_at in delivered
+                ]
+            ).rowcount
+            conn.commit()
+        return marked
+
+    def import_file_storage(self, source):
+        # Переносит списки из users_data/<chat_id>/*.sqlite; уже перенесённые пропускает.
+        # Строка lists и задачи списка пишутся одной транзакцией: после сбоя список не
+        # останется зарегистрированным без задач и перенесётся при следующем запуске
+        imported = failed = 0
+        for chat_id, list_name in source.iter_lists():
+            try:
+                with self.connection() as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    if conn.execute(
+                        "SELECT 1 FROM lists WHERE chat_id = ? AND list_name = ?", (chat_id, list_name)
+                    ).fetchone():
+                        conn.rollback()
+                        print(f"Пропущено (уже есть): {chat_id}/{list_name}")
+                        continue
+
+                    with source.connection(chat_id, list_name) as src:
+                        rows = src.execute(
+                            """SELECT problem, time_create, time_send, confirmed, last_notification, recurrence,
+                               due_at, notified_at, notify_count FROM problems ORDER BY problem_id"""
+                        ).fetchall()
+
+                    conn.execute("INSERT INTO lists (chat_id, list_name) VALUES (?, ?)", (chat_id, list_name))
+                    conn.executemany(
+                        """INSERT INTO problems
+                           (chat_id, list_name, problem, time_create, time_send, confirmed, last_notification,
+                            recurrence, due_at, notified_at, notify_count)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        [(chat_id, list_name, *row) for row in rows]
+                    )
+                    conn.commit()
+            except Exception as e:
+                failed += 1
+                report_error("migrate_storage", f"Ошибка переноса {chat_id}/{list_name}: {e}")
+                continue
+
+            self.registry.add(chat_id, list_name)
+            imported += 1
+            print(f"Перенесено: {chat_id}/{list_name} ({len(rows)} задач)")
+        if failed:
+            print(f"Не перенесено списков: {failed}, запустите перенос ещё раз")
+        return imported
+
+def create_storage():
+    if STORAGE_BACKEND == "single":
+        return SingleFileStorage(STORAGE_DB_PATH)
+    return FileStorage()
+
+
+storage = InstrumentedStorage(create_storage())
+
+
+def can_create_more_dbs(chat_id):
+    return len(storage.list_names(chat_id)) < MAX_DBS_PER_USER
+
+
+def create_db_if_not_exists(chat_id, db_name):
+    return storage.create_list(chat_id, db_name)
+
+
+def delete_db(chat_id, db_name):
+    if not storage.delete_list(chat_id, db_name):
+        return False
+    unschedule_db(chat_id, db_name)
+    invalidate_listing(chat_id, db_name)
+    forget_callback_list(chat_id, db_name)
     return True
 
 
-def get_problems_from_db(chat_id, db_name):
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
+def get_user_dbs(chat_id):
+    return storage.list_names(chat_id)
+
 
-    if not os.path.exists(db_path):
+def state_connection():
+    return db_connection((None, STATE_DB_PATH), STATE_DB_PATH, STATE_MIGRATIONS)
+
+
+def chat_timezone(chat_id):
+    name = chat_timezones.get(chat_id)
+    if name is None:
+        with state_connection() as conn:
+            row = conn.execute("SELECT timezone FROM chat_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+        name = chat_timezones[chat_id] = row[0] if row else DEFAULT_TIMEZONE
+    return get_timezone(name)
+
+
+def set_chat_timezone(chat_id, name):
+    # Время задач задано по часам чата - пересчитываем due_at и очередь напоминаний
+    with state_connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO chat_settings (chat_id, timezone) VALUES (?, ?)", (chat_id, name)
+        )
+        conn.commit()
+    chat_timezones[chat_id] = name
+
+    tz = get_timezone(name)
+    for db_name in get_user_dbs(chat_id):
+        storage.update_due_times(chat_id, db_name, tz)
+        unschedule_db(chat_id, db_name)
+        warm_up_list(chat_id, db_name, load_queue=True)
+
+
+def set_next_step(chat_id, step):
+    # Следующее сообщение чата уйдёт обработчику next_step_handlers[step]
+    with state_connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO pending_steps (chat_id, step, expires_at) VALUES (?, ?, ?)",
+            (chat_id, step, int(time.time()) + NEXT_STEP_TTL)
+        )
+        conn.commit()
+    next_step_chats[chat_id] = int(time.time()) + NEXT_STEP_TTL
+
+
+def load_next_steps():
+    now = int(time.time())
+    with state_connection() as conn:
+        rows = conn.execute("SELECT chat_id, expires_at FROM pending_steps WHERE expires_at > ?", (now,)).fetchall()
+    next_step_chats.update(rows)
+
+
+def has_next_step(chat_id):
+    if not NEXT_STEP_SHARED:
+        expires_at = next_step_chats.get(chat_id)
+        return expires_at is not None and expires_at > time.time()
+
+    with state_connection() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM pending_steps WHERE chat_id = ? AND expires_at > ?", (chat_id, int(time.time()))
+        ).fetchone()
+    return row is not None
+
+
+def pop_next_step(chat_id):
+    # Шаг достаётся только тому процессу, чей DELETE его удалил
+    next_step_chats.pop(chat_id, None)
+    with state_connection() as conn:
+        row = conn.execute(
+            "SELECT step, expires_at FROM pending_steps WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        deleted = conn.execute(
+            "DELETE FROM pending_steps WHERE chat_id = ? AND step = ? AND expires_at = ?", (chat_id, *row)
+        ).rowcount
+        conn.commit()
+    if not deleted or row[1] <= time.time():
         return None
+    return row[0]
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT problem_id, problem, time_create, time_send FROM problems")
-    problems = cursor.fetchall()
-    conn.close()
-    return problems
 
+def purge_next_steps(now):
+    with state_connection() as conn:
+        purged = conn.execute("DELETE FROM pending_steps WHERE expires_at <= ?", (int(now),)).rowcount
+        conn.commit()
+    for chat_id, expires_at in list(next_step_chats.items()):
+        if expires_at <= now:
+            next_step_chats.pop(chat_id, None)
+    return purged
 
-def delete_problem_from_db(chat_id, db_name, problem_id):
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
 
-    if not os.path.exists(db_path):
+def db_exists(chat_id, db_name):
+    return storage.list_exists(chat_id, db_name)
+
+
+def add_problem_to_db(chat_id, db_name, problem, time_send, due_at, recurrence=None):
+    problem_id = storage.add_problem(chat_id, db_name, problem, time_send, due_at, recurrence)
+    if problem_id is None:
         return False
+    schedule_task(chat_id, db_name, problem_id, due_at)
+    invalidate_listing(chat_id, db_name)
+    return True
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM problems WHERE problem_id = ?",
-        (problem_id,)
-    )
-    conn.commit()
-    conn.close()
+
+def add_problems_to_db(chat_id, db_name, problems):
+    added = storage.add_problems(chat_id, db_name, problems)
+    if added is None:
+        return None
+    for problem_id, due_at in added:
+        schedule_task(chat_id, db_name, problem_id, due_at)
+    invalidate_listing(chat_id, db_name)
+    return len(added)
+
+
+def get_problems_from_db(chat_id, db_name):
+    return storage.get_problems(chat_id, db_name)
+
+
+def delete_problem_from_db(chat_id, db_name, problem_id):
+    if not storage.delete_problem(chat_id, db_name, problem_id):
+        return False
+    unschedule_task(chat_id, db_name, problem_id)
+    invalidate_listing(chat_id, db_name)
     return True
 
 
+def invalidate_listing(chat_id, db_name):
+    global listing_epoch
+    with listing_lock:
+        listing_epoch += 1
+        listing_cache.pop((chat_id, db_name), None)
+
+
+def cached_listing(chat_id, db_name, kind, page, render):
+    key = (chat_id, db_name)
+    with listing_lock:
+        pages = listing_cache.get(key)
+        if pages is not None and (kind, page) in pages:
+            listing_cache.move_to_end(key)
+            return pages[(kind, page)]
+        epoch = listing_epoch
+
+    result = render(chat_id, db_name, page)
+
+    with listing_lock:
+        if epoch == listing_epoch:
+            listing_cache.setdefault(key, {})[(kind, page)] = result
+            listing_cache.move_to_end(key)
+            if len(listing_cache) > LISTING_CACHE_SIZE:
+                listing_cache.popitem(last=False)
+    return result
+
+
+# Код действия - позиция в списке: кнопки живут в чатах, порядок не менять
+CALLBACK_ACTIONS = ["delete_db", "delete_task", "confirm_task", "list_page", "del_page", "digest_confirm", "digest_page"]
+CALLBACK_FORMAT = struct.Struct(">B6sq")
+
+
+@functools.lru_cache(maxsize=CALLBACK_CACHE_SIZE)
+def list_key(db_name):
+    return hashlib.blake2b(db_name.encode(), digest_size=6).digest()
+
+
+def encode_callback(action, db_name, value=0):
+    packed = CALLBACK_FORMAT.pack(CALLBACK_ACTIONS.index(action), list_key(db_name), int(value))
+    return base64.urlsafe_b64encode(packed).decode()
+
+
+def remember_callback_list(chat_id, db_name):
+    # Вызывается под callback_lock
+    key = (chat_id, list_key(db_name))
+    callback_lists[key] = db_name
+    callback_lists.move_to_end(key)
+    while len(callback_lists) > CALLBACK_CACHE_SIZE:
+        callback_lists.popitem(last=False)
+
+
+def resolve_callback_list(chat_id, key):
+    with callback_lock:
+        db_name = callback_lists.get((chat_id, key))
+        if db_name is not None:
+            callback_lists.move_to_end((chat_id, key))
+            return db_name
+    names = get_user_dbs(chat_id)
+    with callback_lock:
+        for name in names:
+            remember_callback_list(chat_id, name)
+        return callback_lists.get((chat_id, key))
+
+
+def decode_callback(chat_id, data):
+    # -> (действие, список, число); None - кнопка не наша или список уже удалён
+    if ":" in data:
+        # Кнопки старого формата "действие:список[:число]" из уже отправленных сообщений
+        parts = data.split(":")
+        if parts[0] not in CALLBACK_ACTIONS or len(parts) > 3:
+            return None
+        try:
+            value = int(parts[2]) if len(parts) == 3 else 0
+        except ValueError:
+            return None
+        # delete_db до перехода на хранилище содержит имя файла
+        return parts[0], parts[1].replace(".sqlite", ""), value
+
+    try:
+        code, key, value = CALLBACK_FORMAT.unpack(base64.urlsafe_b64decode(data))
+    except (ValueError, struct.error):
+        return None
+    if code >= len(CALLBACK_ACTIONS):
+        return None
+    # Пустое название - у кнопок, которые не относятся к одному списку (страницы дайджеста)
+    db_name = "" if key == list_key("") else resolve_callback_list(chat_id, key)
+    if db_name is None:
+        return None
+    return CALLBACK_ACTIONS[code], db_name, value
+
+
+def forget_callback_list(chat_id, db_name):
+    with callback_lock:
+        callback_lists.pop((chat_id, list_key(db_name)), None)
+
+
+def shorten(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def utf16_length(text):
+    # Лимит Telegram на длину сообщения считается в единицах UTF-16: эмодзи - две
+    return len(text.encode("utf-16-le")) // 2
+
+
+def shorten_utf16(text, limit):
+    if utf16_length(text) <= limit:
+        return text
+    # Половинка суррогатной пары на границе отбрасывается при декодировании
+    return text.encode("utf-16-le")[:max(limit - 1, 0) * 2].decode("utf-16-le", "ignore") + "…"
+
+
+def load_problems_page(chat_id, db_name, page):
+    # (задачи страницы, номер страницы, всего страниц); номер за пределами - последняя
+    pages = max(1, -(-storage.count_problems(chat_id, db_name) // PROBLEMS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    problems = storage.get_problems_page(chat_id, db_name, PROBLEMS_PAGE_SIZE, page * PROBLEMS_PAGE_SIZE)
+    return problems, page, pages
+
+
+def add_page_buttons(markup, prefix, db_name, page, pages):
+    if pages <= 1:
+        return
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton("⬅️", callback_data=encode_callback(prefix, db_name, page - 1)))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton("➡️", callback_data=encode_callback(prefix, db_name, page + 1)))
+    markup.row(*buttons)
+
+
+def render_problem_list(chat_id, db_name, page):
+    problems, page, pages = load_problems_page(chat_id, db_name, page)
+    if not problems:
+        return None, None
+
+    # Каждой задаче - равная доля сообщения в единицах UTF-16; текст задачи
+    # обрезаем под то, что осталось от доли после остальных строк
+    header = f"📋 Список задач (стр. {page + 1}/{pages}):\n"
+    task_budget = (MAX_MESSAGE_LENGTH - utf16_length(header)) // PROBLEMS_PAGE_SIZE
+    parts = [header]
+    for task_id, task_text, time_create, time_send, recurrence in problems:
+        repeat = f"🔁 Повтор: {shorten(recurrence, MAX_RECURRENCE_SHOWN)}\n" if recurrence else ""
+        head = f"🔹 ID: {task_id}\n📌 Задача: "
+        tail = f"\n🕒 Создана: {time_create}\n⏰ Выполнить: {time_send}\n{repeat}\n"
+        room = task_budget - utf16_length(head) - utf16_length(tail)
+        parts.append(head + shorten_utf16(task_text, room) + tail)
+
+    markup = types.InlineKeyboardMarkup()
+    add_page_buttons(markup, "list_page", db_name, page, pages)
+    return "".join(parts), markup
+
+
+def render_delete_keyboard(chat_id, db_name, page):
+    problems, page, pages = load_problems_page(chat_id, db_name, page)
+    if not problems:
+        return None, None
+
+    markup = types.InlineKeyboardMarkup()
+    for task_id, task_text, _, time_send, _ in problems:
+        markup.add(
+            types.InlineKeyboardButton(
+                f"❌ {task_id}: {shorten(task_text, 40)} (до {time_send})",
+                callback_data=encode_callback("delete_task", db_name, task_id)
+            )
+        )
+    add_page_buttons(markup, "del_page", db_name, page, pages)
+    return f"🗑 Выберите задачу для удаления (стр. {page + 1}/{pages}):", markup
+
+
+def chat_overdue_tasks(chat_id, now):
+    # (db_name, task_id, задача, time_send, notify_count, notified_at, lease_until)
+    # просроченных задач всех списков чата
+    tasks = []
+    for db_name in get_user_dbs(chat_id):
+        tasks.extend((db_name, *task) for task in storage.overdue_tasks(chat_id, db_name, now))
+    return tasks
+
+
+def render_digest(tasks, page):
+    pages = max(1, -(-len(tasks) // DIGEST_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    max_task_length = max(40, MAX_MESSAGE_LENGTH // DIGEST_PAGE_SIZE - 100)
+
+    header = f"🔔 Напоминания: {len(tasks)}"
+    if pages > 1:
+        header += f" (стр. {page + 1}/{pages})"
+    parts = [header + "\n"]
+    markup = types.InlineKeyboardMarkup()
+    for db_name, task_id, task_text, time_send, *_ in tasks[page * DIGEST_PAGE_SIZE:(page + 1) * DIGEST_PAGE_SIZE]:
+        parts.append(f"\n📌 {shorten(task_text, max_task_length)}\n⏰ {time_send} ({db_name})\n")
+        markup.add(
+            types.InlineKeyboardButton(
+                f"✅ {shorten(task_text, 40)}",
+                callback_data=encode_callback("digest_confirm", db_name, task_id)
+            )
+        )
+    add_page_buttons(markup, "digest_page", "", page, pages)
+    return "".join(parts), markup
+
+
+def get_problem_list(chat_id, db_name, page=0):
+    return cached_listing(chat_id, db_name, "list", page, render_problem_list)
+
+
+def get_delete_keyboard(chat_id, db_name, page=0):
+    return cached_listing(chat_id, db_name, "delete", page, render_delete_keyboard)
+
+
+def schedule_task(chat_id, db_name, problem_id, due_at):
+    if reminder_coordinator is not None:
+        reminder_coordinator.publish(chat_id, ("schedule", chat_id, db_name, int(problem_id), due_at))
+        return
+
+    problem_id = int(problem_id)
+    with due_lock:
+        due_index.setdefault((chat_id, db_name), {})[problem_id] = due_at
+        heapq.heappush(due_queue, (due_at, chat_id, db_name, problem_id))
+        if due_queue[0][0] == due_at:
+            due_wakeup.notify_all()
+        # Чистим кучу от устаревших записей, если их накопилось слишком много
+        live = sum(len(tasks) for tasks in due_index.values())
+        if len(due_queue) > 2 * live + 1024:
+            due_queue[:] = [
+                (ts, c, d, p) for (c, d), tasks in due_index.items() for p, ts in tasks.items()
+                if ts is not None
+            ]
+            heapq.heapify(due_queue)
+
+
+def unschedule_task(chat_id, db_name, problem_id):
+    if reminder_coordinator is not None:
+        reminder_coordinator.publish(chat_id, ("unschedule", chat_id, db_name, int(problem_id)))
+        return
+
+    with due_lock:
+        tasks = due_index.get((chat_id, db_name))
+        if tasks is not None:
+            tasks.pop(int(problem_id), None)
+            if not tasks:
+                del due_index[(chat_id, db_name)]
+
+
+def unschedule_db(chat_id, db_name):
+    if reminder_coordinator is not None:
+        reminder_coordinator.publish(chat_id, ("drop_list", chat_id, db_name))
+        return
+
+    with due_lock:
+        due_index.pop((chat_id, db_name), None)
+
+
+def next_due_time():
+    # Время ближайшей актуальной записи кучи; вызывается под due_lock
+    while due_queue:
+        due_at, chat_id, db_name, problem_id = due_queue[0]
+        if due_index.get((chat_id, db_name), {}).get(problem_id) == due_at:
+            return due_at
+        heapq.heappop(due_queue)
+    return None
+
+
+def pop_due_tasks(now):
+    # Возвращает {(chat_id, db_name): {problem_id: due_at}} для наступивших к now задач
+    due = {}
+    with due_lock:
+        while due_queue and due_queue[0][0] <= now:
+            due_at, chat_id, db_name, problem_id = heapq.heappop(due_queue)
+            tasks = due_index.get((chat_id, db_name))
+            if tasks is None or tasks.get(problem_id) != due_at:
+                continue
+            # Задача "в работе": дубликаты этой записи в куче больше не совпадут
+            tasks[problem_id] = None
+            due.setdefault((chat_id, db_name), {})[problem_id] = due_at
+    return due
+
+
+# Ответ на вопрос бота. Регистрируется первым: шаг диалога важнее команд,
+# как register_next_step_handler в TeleBot
+def next_step_filter(message):
+    return has_next_step(message.chat.id)
+
+
+@bot.message_handler(func=next_step_filter)
+def handle_next_step(message):
+    step = pop_next_step(message.chat.id)
+    # Шаг мог забрать другой процесс или он истёк между проверкой и обработкой
+    handler = next_step_handlers.get(step)
+    if handler is not None:
+        handler(message)
+
+
 # Команда /start
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
-    user_folder = create_user_folder(message.chat.id)
+    user_folder = storage.user_location(message.chat.id)
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add("📅 Распорядок дня", "✅ Текущая задача")
 
@@ -142,12 +1971,12 @@ def handle_new_problem(message):
         bot.send_message(chat_id, f"❌ Превышен лимит ({MAX_DBS_PER_USER} БД на пользователя)!")
         return
 
-    msg = bot.send_message(
+    bot.send_message(
         chat_id,
         "📝 Введите название для базы данных (только латиница, цифры и _):",
         reply_markup=types.ForceReply(selective=True)
     )
-    bot.register_next_step_handler(msg, process_db_name)
+    set_next_step(chat_id, "db_name")
 
 
 def process_db_name(message):
@@ -168,9 +1997,9 @@ def process_db_name(message):
 
     try:
         if create_db_if_not_exists(chat_id, db_name):
-            bot.send_message(chat_id, f"✅ База данных `{db_name}.sqlite` создана!", parse_mode="Markdown")
+            bot.send_message(chat_id, f"✅ База данных `{db_name}` создана!", parse_mode="Markdown")
         else:
-            bot.send_message(chat_id, f"❌ Файл `{db_name}.sqlite` уже существует!", parse_mode="Markdown")
+            bot.send_message(chat_id, f"❌ База данных `{db_name}` уже существует!", parse_mode="Markdown")
     except Exception as e:
         bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
 
@@ -187,7 +2016,7 @@ def handle_delete_problem_list(message):
 
     markup = types.InlineKeyboardMarkup()
     for db in dbs:
-        markup.add(types.InlineKeyboardButton(db, callback_data=f"delete_db:{db}"))
+        markup.add(types.InlineKeyboardButton(db, callback_data=encode_callback("delete_db", db)))
 
     bot.send_message(
         chat_id,
@@ -197,15 +2026,12 @@ def handle_delete_problem_list(message):
 
 
 # Обработчик кнопок удаления БД
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_db:"))
-def handle_delete_db(call):
+def handle_delete_db(call, db_name, _):
     chat_id = call.message.chat.id
-    db_name = call.data.split(":")[1]
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}"
 
     try:
-        os.remove(db_path)
+        if not delete_db(chat_id, db_name):
+            raise FileNotFoundError(db_name)
         bot.answer_callback_query(call.id, f"✅ {db_name} удалена!")
         bot.edit_message_text(
             f"🗑 База данных `{db_name}` успешно удалена.",
@@ -216,18 +2042,164 @@ def handle_delete_db(call):
         bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
 
 
+# Правила повторения задач. Задача хранится одной строкой, time_send - ближайшее
+# срабатывание; подтверждение переносит его на следующее (advance_task).
+#   daily              - каждый день в то же время
+#   weekdays           - по будням в то же время
+#   every N            - каждые N минут
+#   cron M H DOM MON DOW - как в crontab (*, списки, диапазоны, шаг /N; DOW 0-7, 0 и 7 - воскресенье)
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+CRON_SEARCH_DAYS = 366 * 8  # 29 февраля в понедельник встречается раз в 28 лет, дальше не ищем
+
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"поле {field} вне диапазона {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def cron_schedule(fields):
+    minutes, hours, days, months, weekdays = (
+        parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_RANGES)
+    )
+    if 7 in weekdays:
+        weekdays = (weekdays - {7}) | {0}
+    return sorted(minutes), sorted(hours), days, months, weekdays, fields[2] == '*', fields[4] == '*'
+
+
+def next_occurrence(recurrence, anchor, after):
+    # Первое срабатывание правила строго после after; anchor - время, от которого
+    # отсчитываются daily, weekdays и every N
+    words = recurrence.split()
+    if words[0] == "every":
+        step = timedelta(minutes=int(words[1]))
+        if anchor > after:
+            return anchor
+        return anchor + step * ((after - anchor) // step + 1)
+
+    if words[0] in ("daily", "weekdays"):
+        day = timedelta(days=1)
+        result = anchor if anchor > after else anchor + day * ((after - anchor) // day + 1)
+        while words[0] == "weekdays" and result.weekday() >= 5:
+            result += day
+        return result
+
+    minutes, hours, days, months, weekdays, any_day, any_weekday = cron_schedule(words[1:])
+    start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    date = start.date()
+    for _ in range(CRON_SEARCH_DAYS):
+        day_match = date.day in days
+        weekday_match = (date.weekday() + 1) % 7 in weekdays
+        # Как в cron: если ограничены и число, и день недели - достаточно одного
+        if any_day:
+            day_match = weekday_match
+        elif not any_weekday:
+            day_match = day_match or weekday_match
+        if date.month in months and day_match:
+            for hour in hours:
+                for minute in minutes:
+                    result = datetime(date.year, date.month, date.day, hour, minute)
+                    if result >= start:
+                        return result
+        date += timedelta(days=1)
+    raise ValueError("правило никогда не срабатывает")
+
+
+def parse_recurrence(rule):
+    # Текст правила -> каноническая запись для столбца recurrence; ValueError, если не разобрать
+    words = rule.lower().split()
+    if words in (["daily"], ["weekdays"]):
+        recurrence = words[0]
+    elif len(words) == 2 and words[0] == "every" and words[1].isdigit() and int(words[1]) > 0:
+        recurrence = f"every {int(words[1])}"
+    elif len(words) == 6 and words[0] == "cron":
+        recurrence = " ".join(words)
+    else:
+        raise ValueError(
+            f"Неизвестное правило повторения: {rule}! "
+            "Допустимо: daily, weekdays, every N (минут), cron M H DOM MON DOW"
+        )
+    try:
+        now = datetime.now()
+        next_occurrence(recurrence, now, now)
+    except ValueError as e:
+        raise ValueError(f"Некорректное правило повторения {rule}: {e}")
+    return recurrence
+
+
+def first_time_send(recurrence, time_send, now):
+    # Первое срабатывание повторяющейся задачи: time_send, если оно ещё впереди
+    # и подходит под правило, иначе ближайшее следующее
+    anchor = datetime.strptime(time_send, "%Y-%m-%d %H:%M:%S")
+    after = max(anchor - timedelta(seconds=1), now)
+    return next_occurrence(recurrence, anchor, after).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def advance_time_send(recurrence, time_send, now):
+    # Следующее срабатывание после подтверждения: пропущенные, пока задачу
+    # не подтверждали, не навёрстываем
+    current = datetime.strptime(time_send, "%Y-%m-%d %H:%M:%S")
+    return next_occurrence(recurrence, current, max(current, now)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_time_send(day, hours, minutes, now=None):
+    # День/часы/минуты из /addproblem -> time_send; ValueError с текстом для пользователя
+    # Проверка времени (часы и минуты обязательны)
+    if not hours.isdigit() or not minutes.isdigit():
+        raise ValueError("Часы и минуты должны быть числами!")
+
+    hours = int(hours)
+    minutes = int(minutes)
+
+    if hours < 0 or hours > 23 or minutes < 0 or minutes > 59:
+        raise ValueError("Часы (0-23) и минуты (0-59) должны быть в допустимом диапазоне!")
+
+    # Если день не указан, берём сегодняшний
+    now = now or datetime.now()
+    if not day:
+        day = str(now.day)
+    elif not day.isdigit():
+        raise ValueError("День должен быть числом (1-31) или пустым!")
+
+    day = int(day)
+    if day < 1 or day > 31:
+        raise ValueError("День должен быть от 1 до 31!")
+
+    # Формируем дату (год и месяц берём текущие)
+    try:
+        return datetime(now.year, now.month, day, hours, minutes).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise ValueError("Некорректная дата (например, 31 февраля)!")
+
+
 # Команда /addproblem
 @bot.message_handler(commands=['addproblem'])
 def handle_add_problem(message):
     chat_id = message.chat.id
-    command_parts = message.text.split()
+    command_parts = message.text.split(maxsplit=1)
 
     if len(command_parts) < 2:
         bot.send_message(
             chat_id,
             "❌ Неверный формат!\n"
             "Пример: `/addproblem problem1:wakeup:1:8:45`\n"
-            "Или: `/addproblem problem1:wakeup::8:45` (дата = сегодня)",
+            "Или: `/addproblem problem1:wakeup::8:45` (дата = сегодня)\n"
+            "Повтор: `/addproblem problem1:wakeup::8:45:daily` "
+            "(daily, weekdays, every N, cron M H DOM MON DOW)",
             parse_mode="Markdown"
         )
         return
@@ -248,68 +2220,217 @@ def handle_add_problem(message):
     day = args[2]
     hours = args[3]
     minutes = args[4]
+    rule = ":".join(args[5:]).strip()
 
-    # Проверка времени (часы и минуты обязательны)
-    if not hours.isdigit() or not minutes.isdigit():
-        bot.send_message(chat_id, "❌ Часы и минуты должны быть числами!")
+    # Время задачи - по часам чата
+    tz = chat_timezone(chat_id)
+    now = local_now(tz)
+    try:
+        time_send = parse_time_send(day, hours, minutes, now)
+        recurrence = None
+        if rule:
+            recurrence = parse_recurrence(rule)
+            time_send = first_time_send(recurrence, time_send, now)
+    except ValueError as e:
+        bot.send_message(chat_id, f"❌ {e}")
         return
 
-    hours = int(hours)
-    minutes = int(minutes)
-
-    if hours < 0 or hours > 23 or minutes < 0 or minutes > 59:
-        bot.send_message(chat_id, "❌ Часы (0-23) и минуты (0-59) должны быть в допустимом диапазоне!")
+    # Проверяем, существует ли БД
+    if not db_exists(chat_id, db_name):
+        bot.send_message(chat_id, f"❌ База данных `{db_name}` не существует!", parse_mode="Markdown")
         return
 
-    # Если день не указан, берём сегодняшний
-    if not day:
-        today = datetime.now().day
-        day = str(today)
-    elif not day.isdigit():
-        bot.send_message(chat_id, "❌ День должен быть числом (1-31) или пустым!")
+    # Добавляем задачу в БД
+    if add_problem_to_db(chat_id, db_name, problem_text, time_send, local_epoch(time_send, tz), recurrence):
+        # Показываем последнюю страницу списка - с только что добавленной задачей
+        tasks_list, markup = get_problem_list(chat_id, db_name, page=sys.maxsize)
+        if not tasks_list:
+            bot.send_message(chat_id, f"✅ Задача добавлена, но список задач пуст.")
+            return
+
+        bot.send_message(chat_id, tasks_list, reply_markup=markup)
+    else:
+        bot.send_message(chat_id, "❌ Ошибка при добавлении задачи!")
+
+
+# Команда /addproblems: по задаче на строку в формате /addproblem
+@bot.message_handler(commands=['addproblems'])
+def handle_add_problems(message):
+    chat_id = message.chat.id
+    lines = message.text.split('\n')
+    first = lines[0].split(maxsplit=1)
+    lines = first[1:] + lines[1:]
+    entries = [(n, line.strip().split(':')) for n, line in enumerate(lines, 1) if line.strip()]
+
+    if not entries:
+        bot.send_message(
+            chat_id,
+            "❌ Нет задач!\n"
+            "Пишите по задаче на строку после команды:\n"
+            "/addproblems\nproblem1:wakeup:1:8:45\nproblem1:sleep::23:00\n\n"
+            "Шестое поле - необязательное правило повторения (daily, weekdays, every N, cron ...)\n\n"
+            "Или пришлите файл .csv (столбцы: бд, задача, день, часы, минуты, повтор) "
+            "либо .json (список объектов с полями db, task, day, hour, minute, rule)"
+        )
         return
 
-    day = int(day)
-    if day < 1 or day > 31:
-        bot.send_message(chat_id, "❌ День должен быть от 1 до 31!")
+    import_problems(chat_id, entries)
+
+
+# Файл с задачами: .csv или .json
+@bot.message_handler(content_types=['document'])
+def handle_problems_file(message):
+    chat_id = message.chat.id
+    document = message.document
+    file_name = (document.file_name or "").lower()
+
+    if not file_name.endswith((".csv", ".json")):
+        bot.send_message(chat_id, "❌ Принимаются только файлы .csv и .json с задачами!")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        bot.send_message(chat_id, f"❌ Файл больше {IMPORT_MAX_FILE_SIZE // 1024} КБ!")
         return
 
-    # Формируем дату (год и месяц берём текущие)
-    now = datetime.now()
     try:
-        time_send = datetime(now.year, now.month, day, hours, minutes).strftime("%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        bot.send_message(chat_id, "❌ Некорректная дата (например, 31 февраля)!")
+        file_info = bot_result(bot.get_file(document.file_id))
+        data = bot_result(bot.download_file(file_info.file_path)).decode("utf-8-sig")
+        if file_name.endswith(".csv"):
+            entries = read_csv_entries(data)
+        else:
+            entries = read_json_entries(data)
+    except (ValueError, csv.Error) as e:
+        bot.send_message(chat_id, f"❌ Не удалось прочитать файл: {e}")
+        return
+    except Exception as e:
+        report_error("import", f"Ошибка загрузки файла {document.file_name}: {e}")
+        bot.send_message(chat_id, "❌ Не удалось загрузить файл!")
         return
 
-    # Проверяем, существует ли БД
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
-    if not os.path.exists(db_path):
-        bot.send_message(chat_id, f"❌ База данных `{db_name}.sqlite` не существует!", parse_mode="Markdown")
+    if not entries:
+        bot.send_message(chat_id, "❌ В файле нет задач!")
         return
 
-    # Добавляем задачу в БД
-    if add_problem_to_db(chat_id, db_name, problem_text, time_send):
-        # Показываем список задач
-        problems = get_problems_from_db(chat_id, db_name)
-        if not problems:
-            bot.send_message(chat_id, f"✅ Задача добавлена, но список задач пуст.")
-            return
+    import_problems(chat_id, entries)
 
-        tasks_list = "📋 Список задач:\n"
-        for task in problems:
-            task_id, task_text, time_create, time_send = task
-            tasks_list += (
-                f"🔹 ID: {task_id}\n"
-                f"📌 Задача: {task_text}\n"
-                f"🕒 Создана: {time_create}\n"
-                f"⏰ Выполнить: {time_send}\n\n"
-            )
 
-        bot.send_message(chat_id, tasks_list)
-    else:
-        bot.send_message(chat_id, "❌ Ошибка при добавлении задачи!")
+def bot_result(value):
+    # В asyncio-режиме вызовы Bot API возвращают Future - ждём результат
+    if isinstance(value, Future):
+        return value.result()
+    return value
+
+
+def read_csv_entries(data):
+    entries = []
+    for n, row in enumerate(csv.reader(io.StringIO(data)), 1):
+        if not any(field.strip() for field in row):
+            continue
+        # Заголовок необязателен
+        if n == 1 and row[0].strip().lower() == "db":
+            continue
+        entries.append((n, [field.strip() for field in row]))
+    return entries
+
+
+def read_json_entries(data):
+    items = json.loads(data)
+    if not isinstance(items, list):
+        raise ValueError("ожидается список задач")
+    entries = []
+    for n, item in enumerate(items, 1):
+        if isinstance(item, str):
+            entries.append((n, item.strip().split(':')))
+        elif isinstance(item, dict):
+            values = [item.get(key) for key in ("db", "task", "day", "hour", "minute", "rule")]
+            entries.append((n, ["" if value is None else str(value).strip() for value in values]))
+        else:
+            entries.append((n, []))
+    return entries
+
+
+def import_problems(chat_id, entries):
+    # entries: [(номер строки, [бд, задача, день, часы, минуты, повтор])]. Сначала проверяем все
+    # строки и добавляем, только если ошибок нет - по одной транзакции на список
+    if len(entries) > IMPORT_MAX_TASKS:
+        bot.send_message(chat_id, f"❌ Слишком много задач: {len(entries)}, максимум {IMPORT_MAX_TASKS}!")
+        return
+
+    tz = chat_timezone(chat_id)
+    now = local_now(tz)
+    known_dbs = set(get_user_dbs(chat_id))
+    by_db = {}
+    errors = []
+    for n, fields in entries:
+        if len(fields) < 5:
+            errors.append(f"{n}: не хватает параметров (бд:задача:день:часы:минуты)")
+            continue
+        db_name, problem_text, day, hours, minutes = fields[:5]
+        rule = ":".join(fields[5:]).strip()
+        if db_name not in known_dbs:
+            errors.append(f"{n}: база данных {db_name} не существует")
+            continue
+        if not problem_text:
+            errors.append(f"{n}: пустая задача")
+            continue
+        try:
+            time_send = parse_time_send(day, hours, minutes, now)
+            recurrence = None
+            if rule:
+                recurrence = parse_recurrence(rule)
+                time_send = first_time_send(recurrence, time_send, now)
+        except ValueError as e:
+            errors.append(f"{n}: {e}")
+            continue
+        by_db.setdefault(db_name, []).append((problem_text, time_send, local_epoch(time_send, tz), recurrence))
+
+    if errors:
+        shown = errors[:IMPORT_MAX_ERRORS]
+        if len(errors) > len(shown):
+            shown.append(f"... и ещё {len(errors) - len(shown)}")
+        bot.send_message(chat_id, "❌ Задачи не добавлены, ошибки в строках:\n" + "\n".join(shown))
+        return
+
+    report = []
+    for db_name, problems in by_db.items():
+        added = add_problems_to_db(chat_id, db_name, problems)
+        if added is None:
+            report.append(f"❌ {db_name}: ошибка при добавлении")
+        else:
+            report.append(f"✅ {db_name}: добавлено задач - {added}")
+    bot.send_message(chat_id, "\n".join(report))
+
+
+# Команда /exportproblems: список задач файлом CSV
+@bot.message_handler(commands=['exportproblems'])
+def handle_export_problems(message):
+    chat_id = message.chat.id
+    command_parts = message.text.split()
+
+    if len(command_parts) < 2:
+        bot.send_message(chat_id, "❌ Укажите базу данных: `/exportproblems problem1`", parse_mode="Markdown")
+        return
+
+    db_name = command_parts[1]
+    if not db_exists(chat_id, db_name):
+        bot.send_message(chat_id, f"❌ База данных `{db_name}` не существует!", parse_mode="Markdown")
+        return
+
+    # Строки пишутся в файл порциями, в памяти весь список не держим
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([
+                "problem_id", "problem", "time_create", "time_send", "confirmed", "last_notification", "recurrence"
+            ])
+            writer.writerows(storage.iter_problems(chat_id, db_name, EXPORT_BATCH_SIZE))
+        with open(path, "rb") as f:
+            bot_result(bot.send_document(chat_id, f, visible_file_name=f"{db_name}.csv"))
+    except Exception as e:
+        report_error("export", f"Ошибка выгрузки {db_name} для {chat_id}: {e}")
+        bot.send_message(chat_id, "❌ Ошибка при выгрузке задач!")
+    finally:
+        os.remove(path)
 
 
 # Команда /delproblem
@@ -328,45 +2449,51 @@ def handle_delete_problem(message):
         return
 
     db_name = command_parts[1]
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
-
-    if not os.path.exists(db_path):
-        bot.send_message(chat_id, f"❌ База данных `{db_name}.sqlite` не существует!", parse_mode="Markdown")
+    if not db_exists(chat_id, db_name):
+        bot.send_message(chat_id, f"❌ База данных `{db_name}` не существует!", parse_mode="Markdown")
         return
 
-    problems = get_problems_from_db(chat_id, db_name)
-    if not problems:
+    text, markup = get_delete_keyboard(chat_id, db_name)
+    if not text:
         bot.send_message(chat_id, "❌ В этой БД нет задач для удаления!")
         return
 
-    markup = types.InlineKeyboardMarkup()
-    for task in problems:
-        task_id, task_text, _, time_send = task
-        markup.add(
-            types.InlineKeyboardButton(
-                f"❌ {task_id}: {task_text} (до {time_send})",
-                callback_data=f"delete_task:{db_name}:{task_id}"
-            )
-        )
+    bot.send_message(chat_id, text, reply_markup=markup)
 
-    bot.send_message(
-        chat_id,
-        "🗑 Выберите задачу для удаления:",
-        reply_markup=markup
-    )
+
+# Обработчики кнопок перелистывания списка задач
+def handle_list_page(call, db_name, page):
+    show_page(call, db_name, page, get_problem_list)
+
+
+def handle_del_page(call, db_name, page):
+    show_page(call, db_name, page, get_delete_keyboard)
+
+
+def show_page(call, db_name, page, render):
+    chat_id = call.message.chat.id
+
+    if not db_exists(chat_id, db_name):
+        bot.answer_callback_query(call.id, "❌ База данных не существует!")
+        return
+
+    text, markup = render(chat_id, db_name, page)
+
+    bot.answer_callback_query(call.id)
+    if not text:
+        bot.edit_message_text("📋 Список задач пуст.", chat_id, call.message.message_id)
+        return
+    bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
 
 
 # Обработчик кнопок удаления задачи
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_task:"))
-def handle_delete_task(call):
+def handle_delete_task(call, db_name, problem_id):
     chat_id = call.message.chat.id
-    _, db_name, problem_id = call.data.split(':')
 
     if delete_problem_from_db(chat_id, db_name, problem_id):
         bot.answer_callback_query(call.id, "✅ Задача удалена!")
         bot.edit_message_text(
-            f"🗑 Задача в `{db_name}.sqlite` (ID: {problem_id}) удалена.",
+            f"🗑 Задача в `{db_name}` (ID: {problem_id}) удалена.",
             chat_id,
             call.message.message_id
         )
@@ -407,13 +2534,45 @@ def handle_time_date(message):
         bot.send_message(message.chat.id, f"❌ Ошибка при получении времени: {str(e)}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_task:"))
-def handle_confirmation(call):
+# Команда /timezone: часовой пояс чата, по которому задаётся время задач
+@bot.message_handler(commands=['timezone'])
+def handle_timezone(message):
+    chat_id = message.chat.id
+    command_parts = message.text.split(maxsplit=1)
+
+    if len(command_parts) < 2:
+        now = local_now(chat_timezone(chat_id))
+        bot.send_message(
+            chat_id,
+            f"🌍 Часовой пояс: `{chat_timezones[chat_id]}`, сейчас {now.strftime('%Y-%m-%d %H:%M')}\n"
+            "Изменить: `/timezone Europe/Berlin` или `/timezone +5:30`",
+            parse_mode="Markdown"
+        )
+        return
+
+    try:
+        name = parse_timezone(command_parts[1])
+    except ValueError as e:
+        bot.send_message(chat_id, f"❌ {e}")
+        return
+
+    set_chat_timezone(chat_id, name)
+    now = local_now(get_timezone(name))
+    bot.send_message(
+        chat_id,
+        f"✅ Часовой пояс: `{name}`, сейчас {now.strftime('%Y-%m-%d %H:%M')}\n"
+        "Напоминания по существующим задачам придут по новому поясу.",
+        parse_mode="Markdown"
+    )
+
+
+def handle_confirmation(call, db_name, task_id):
     try:
-        _, db_name, task_id = call.data.split(":")
         chat_id = call.message.chat.id
 
-        confirm_task_in_db(chat_id, db_name, task_id)
+        if not confirm_task_in_db(chat_id, db_name, task_id):
+            bot.answer_callback_query(call.id, "❌ Ошибка подтверждения!")
+            return
 
         bot.edit_message_text(
             "✅ Задача подтверждена",
@@ -423,10 +2582,89 @@ def handle_confirmation(call):
         bot.answer_callback_query(call.id, "Вы приступили к задаче!")
 
     except Exception as e:
-        print(f"Ошибка подтверждения: {e}")
+        report_error("confirm", f"Ошибка подтверждения: {e}")
         bot.answer_callback_query(call.id, "❌ Ошибка подтверждения!")
 
 
+# Кнопки дайджеста напоминаний (REMINDER_DIGEST)
+def handle_digest_page(call, _, page):
+    bot.answer_callback_query(call.id)
+    show_digest(call, page)
+
+
+def show_digest(call, page):
+    chat_id = call.message.chat.id
+    tasks = chat_overdue_tasks(chat_id, int(time.time()))
+    if not tasks:
+        bot.edit_message_text("✅ Все напоминания подтверждены", chat_id, call.message.message_id)
+        return
+    text, markup = render_digest(tasks, page)
+    bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+
+
+def handle_digest_confirm(call, db_name, task_id):
+    chat_id = call.message.chat.id
+    if not confirm_task_in_db(chat_id, db_name, task_id):
+        bot.answer_callback_query(call.id, "❌ Ошибка подтверждения!")
+        return
+    bot.answer_callback_query(call.id, "Вы приступили к задаче!")
+
+    # Убираем только кнопку подтверждённой задачи; когда на странице их не осталось -
+    # показываем первую страницу заново
+    rows = []
+    if call.message.reply_markup is not None:
+        rows = [
+            row for row in call.message.reply_markup.keyboard
+            if all(button.callback_data != call.data for button in row)
+        ]
+    if not any(button.text.startswith("✅") for row in rows for button in row):
+        show_digest(call, 0)
+        return
+    markup = types.InlineKeyboardMarkup()
+    for row in rows:
+        markup.row(*row)
+    bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=markup)
+
+
+# Все кнопки - один обработчик: действие из callback_data выбирает функцию
+callback_handlers = {
+    "delete_db": handle_delete_db,
+    "delete_task": handle_delete_task,
+    "confirm_task": handle_confirmation,
+    "list_page": handle_list_page,
+    "del_page": handle_del_page,
+    "digest_confirm": handle_digest_confirm,
+    "digest_page": handle_digest_page,
+}
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback(call):
+    if call.message is None:
+        bot.answer_callback_query(call.id)
+        return
+    decoded = decode_callback(call.message.chat.id, call.data or "")
+    if decoded is None:
+        bot.answer_callback_query(call.id, "❌ Кнопка устарела")
+        return
+    action, db_name, value = decoded
+    callback_handlers[action](call, db_name, value)
+
+
+# Замер всех обработчиков: handler_seconds{handler="..."}. Подменяем функции в
+# списках TeleBot - их же берут asyncio-режим и вебхук
+for handler in bot.message_handlers + bot.callback_query_handlers:
+    handler["function"] = instrumented("handler", handler["function"], handler=handler["function"].__name__)
+for action, function in callback_handlers.items():
+    callback_handlers[action] = instrumented("handler", function, handler=function.__name__)
+process_db_name = instrumented("handler", process_db_name, handler="process_db_name")
+
+# Шаги диалогов по имени из pending_steps
+next_step_handlers = {
+    "db_name": process_db_name,
+}
+
+
 
 
 import threading
@@ -435,143 +2673,985 @@ from datetime import datetime
 import pytz
 
 
+# Задержка напоминания: фактическая отправка минус запланированное время
+# (time_send для первого напоминания, время повтора для последующих)
+reminder_lag = Histogram([0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300])
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def reserve(self, now):
+        # Списывает токен и возвращает 0 или сколько секунд подождать до следующего
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class SendQueue:
+    # Ограниченная очередь исходящих сообщений с пулом отправителей. Поток
+    # напоминаний только ставит сообщения в очередь, а last_notification
+    # записывается пачкой после фактической доставки.
+
+    def __init__(self, bot, maxsize, workers, global_rate, chat_rate):
+        self.bot = bot  # всегда синхронный TeleBot, в том числе в asyncio-режиме
+        self.jobs = queue.Queue(maxsize)
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = OrderedDict()
+        self.delayed = []  # куча (ready_at, seq, job) для отложенных повторов
+        self.seq = 0
+        self.pending = set()  # (chat_id, (db_name, task_id)) или (chat_id, "digest") уже в очереди
+        self.delivered = []  # (chat_id, db_name, task_id, notified_at)
+        self.released = []  # (chat_id, db_name, task_id) - не отправлены, аренду снимаем
+        self.lock = threading.Lock()
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+        threading.Thread(target=self.timer, daemon=True).start()
+
+    def put_reminder(self, chat_id, db_name, task_id, notified_at, due_at, text, reply_markup):
+        return self.put(chat_id, (db_name, task_id), [(db_name, task_id, notified_at)], due_at, text, reply_markup)
+
+    def put_digest(self, chat_id, deliveries, due_at, text, reply_markup):
+        # deliveries: [(db_name, task_id, notified_at), ...]; пока дайджест чата
+        # ждёт отправки, следующий не ставится
+        return self.put(chat_id, "digest", deliveries, due_at, text, reply_markup)
+
+    def put(self, chat_id, key, deliveries, due_at, text, reply_markup):
+        key = (chat_id, key)
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        # Блокируется, если очередь заполнена: поток напоминаний притормаживает
+        self.jobs.put({
+            "chat_id": chat_id,
+            "text": text,
+            "reply_markup": reply_markup,
+            "key": key,
+            "deliveries": deliveries,
+            "due_at": due_at,
+            "attempt": 0,
+        })
+        return True
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets.popitem(last=False)
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def delay(self, job, seconds):
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.delayed, (time.monotonic() + seconds, self.seq, job))
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+
+            # Чат упёрся в свой лимит - откладываем, не занимая отправителя
+            with self.lock:
+                wait = self.chat_bucket(job["chat_id"]).reserve(time.monotonic())
+            if wait > 0:
+                self.delay(job, wait)
+                continue
+
+            while True:
+                with self.lock:
+                    wait = self.global_bucket.reserve(time.monotonic())
+                if wait <= 0:
+                    break
+                time.sleep(wait)
+
+            self.deliver(job)
+
+    def deliver(self, job):
+        chat_id = job["chat_id"]
+        try:
+            if not self.extend_leases(job):
+                # Аренду забрал другой процесс - отправка отсюда стала бы повтором
+                count_metric("delivery_leases_expired_total")
+                self.finish(job, False, "аренда доставки перехвачена")
+                return
+        except Exception as e:
+            self.retry(job, 2 ** job["attempt"], e)
+            return
+        try:
+            with timed("telegram_send"):
+                self.bot.send_message(chat_id, job["text"], reply_markup=job["reply_markup"])
+        except telebot.apihelper.ApiTelegramException as e:
+            count_metric("telegram_errors_total", code=e.error_code)
+            if e.error_code == 429:
+                retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                with self.lock:
+                    self.chat_bucket(chat_id).pause(time.monotonic(), retry_after)
+                self.retry(job, retry_after, e)
+            else:
+                # 400/403 и т.п. повтор не исправит (например, бот заблокирован)
+                self.finish(job, False, e)
+            return
+        except Exception as e:
+            self.retry(job, 2 ** job["attempt"], e)
+            return
+
+        self.finish(job, True)
+
+    def extend_leases(self, job):
+        # Аренда, взятая проходом напоминаний, отсчитывается заново от отправки: в заполненной
+        # очереди задание может ждать дольше DELIVERY_LEASE. Задачи, чья аренда уже чужая,
+        # из задания убираются; False - не осталось ни одной
+        lease_until = int(time.time()) + DELIVERY_LEASE
+        by_list = {}
+        for db_name, task_id, _ in job["deliveries"]:
+            by_list.setdefault(db_name, []).append(task_id)
+        kept = set()
+        for db_name, task_ids in by_list.items():
+            for task_id in storage.extend_leases(job["chat_id"], db_name, task_ids, lease_owner(), lease_until):
+                kept.add((db_name, task_id))
+        job["deliveries"] = [delivery for delivery in job["deliveries"] if delivery[:2] in kept]
+        return bool(job["deliveries"])
+
+    def retry(self, job, seconds, error):
+        count_metric("reminder_send_retries_total")
+        job["attempt"] += 1
+        if job["attempt"] > SEND_MAX_RETRIES:
+            self.finish(job, False, error)
+            return
+        self.delay(job, seconds)
+
+    def finish(self, job, sent, error=None):
+        with self.lock:
+            self.pending.discard(job["key"])
+            if sent:
+                self.delivered.extend((job["chat_id"], *delivery) for delivery in job["deliveries"])
+            else:
+                # Повтор - по обычному расписанию, не дожидаясь истечения аренды
+                self.released.extend((job["chat_id"], db_name, task_id) for db_name, task_id, _ in job["deliveries"])
+        if sent:
+            count_metric("reminders_sent_total")
+            reminder_lag.observe(max(0.0, time.time() - job["due_at"]))
+        else:
+            count_metric("reminders_failed_total")
+            report_error("send", f"Не удалось отправить напоминание в чат {job['chat_id']}: {error}")
+
+    def timer(self):
+        last_flush = time.monotonic()
+        while True:
+            now = time.monotonic()
+            ready = []
+            with self.lock:
+                while self.delayed and self.delayed[0][0] <= now:
+                    ready.append(heapq.heappop(self.delayed)[2])
+            for job in ready:
+                self.jobs.put(job)
+
+            if now - last_flush >= DELIVERY_FLUSH_INTERVAL:
+                self.flush_deliveries()
+                last_flush = now
+            time.sleep(0.05)
+
+    def flush_deliveries(self):
+        with self.lock:
+            delivered, self.delivered = self.delivered, []
+            released, self.released = self.released, []
+        if released:
+            try:
+                storage.release_leases(released, lease_owner())
+            except Exception as e:
+                report_error("delivery_flush", f"Ошибка снятия аренды ({len(released)} напоминаний): {e}")
+        if not delivered:
+            return
+
+        count_metric("deliveries_flushed_total", len(delivered))
+        try:
+            marked = storage.mark_notified_batch(delivered, lease_owner())
+            # Аренду перехватил другой процесс - напоминание могло прийти дважды
+            if marked < len(delivered):
+                count_metric("delivery_leases_lost_total", len(delivered) - marked)
+        except Exception as e:
+            report_error("delivery_flush", f"Ошибка записи доставки ({len(delivered)} напоминаний): {e}")
+
+
+send_queue = SendQueue(bot, SEND_QUEUE_SIZE, SEND_WORKERS, GLOBAL_SEND_RATE, CHAT_SEND_RATE)
+
+
 def confirm_task_in_db(chat_id, db_name, task_id):
-    user_folder = create_user_folder(chat_id)
-    db_path = f"{user_folder}/{db_name}.sqlite"
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE problems SET confirmed = TRUE WHERE problem_id = ?",
-        (task_id,)
-    )
-    conn.commit()
-    conn.close()
+    # Повторяющаяся задача остаётся в списке со следующим временем, разовая - подтверждается
+    due_at = storage.advance_task(chat_id, db_name, task_id, chat_timezone(chat_id))
+    if due_at is not None:
+        schedule_task(chat_id, db_name, task_id, due_at)
+    elif storage.confirm_task(chat_id, db_name, task_id):
+        unschedule_task(chat_id, db_name, task_id)
+    else:
+        return False
+    invalidate_listing(chat_id, db_name)
+    return True
 
 
-def check_and_notify():
-    msk_timezone = pytz.timezone('Europe/Moscow')
+def renotify_delay(notify_count):
+    # Пауза после notify_count-го напоминания; степень ограничена, чтобы не переполнить float
+    exponent = min(max(notify_count - 1, 0), 64)
+    return int(min(RENOTIFY_MAX_INTERVAL, RENOTIFY_INTERVAL * RENOTIFY_BACKOFF ** exponent))
 
-    while True:
-        try:
-            now_msk = datetime.now(msk_timezone)
-            current_time_str = now_msk.strftime("%Y-%m-%d %H:%M:%S")
 
-            for user_folder in os.listdir("users_data"):
-                if not user_folder.isdigit():
+def lease_owner():
+    # Метка своя у каждого процесса и каждого запуска: у процессов напоминаний свои pid,
+    # а после перезапуска контейнера pid может совпасть с прежним
+    owner = lease_owners.get(os.getpid())
+    if owner is None:
+        owner = lease_owners[os.getpid()] = f"{os.getpid()}-{os.urandom(4).hex()}"
+    return owner
+
+
+def next_reminder_time(due_at, notified_at, notify_count):
+    # Задачи со старым time_send, которое не удалось разобрать (due_at NULL), - сразу
+    due_at = due_at or 0
+    if not notified_at:
+        return due_at
+    return max(due_at, notified_at + renotify_delay(notify_count))
+
+
+def warm_up_list(chat_id, db_name, load_queue):
+    # Первое открытие применяет миграции; затем задачи списка попадают в очередь
+    if not load_queue:
+        storage.migrate_list(chat_id, db_name)
+        return
+
+    # Аренду, взятую до перезапуска, забираем, когда она истечёт
+    for problem_id, due_at, notified_at, notify_count, lease_until in storage.pending_tasks(chat_id, db_name):
+        due_at = next_reminder_time(due_at, notified_at, notify_count)
+        schedule_task(chat_id, db_name, problem_id, max(due_at, lease_until or 0))
+
+
+def warm_up_storage(workers=None, load_queue=True):
+    # Миграция и загрузка очереди напоминаний по всем спискам в пуле потоков.
+    # Обработчик, обратившийся к ещё не мигрированной БД, мигрирует её сам
+    # или ждёт на её блокировке, пока это делает пул. Процесс напоминаний
+    # загружает только свои чаты.
+    lists = storage.iter_lists()
+    if reminder_shard is not None:
+        shard, shards = reminder_shard
+        lists = [(chat_id, db_name) for chat_id, db_name in lists if shard_of(chat_id, shards) == shard]
+    done = failed = 0
+    last_report = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers or STARTUP_WORKERS) as executor:
+        futures = {
+            executor.submit(warm_up_list, chat_id, db_name, load_queue): (chat_id, db_name)
+            for chat_id, db_name in lists
+        }
+        for future in as_completed(futures):
+            done += 1
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                startup_failures[futures[future]] = str(e)
+                report_error("migration", f"Ошибка миграции {futures[future][0]}/{futures[future][1]}: {e}")
+
+            if done == len(lists) or time.monotonic() - last_report >= 5:
+                print(f"Миграция и загрузка: {done}/{len(lists)} БД, ошибок: {failed}")
+                last_report = time.monotonic()
+
+    print(f"Обращения хранилища при старте: {dict(storage_counters)}")
+    return failed
+
+
+def notify_due_tasks(now):
+    # now - секунды UTC
+    now = int(now)
+
+    # Открываем только те БД, в которых есть наступившие задачи
+    due_lists = pop_due_tasks(now)
+    count_metric("reminder_lists_opened_total", len(due_lists))
+    if REMINDER_DIGEST:
+        notify_digests(now, due_lists)
+        return
+
+    for (chat_id, db_name), due_times in due_lists.items():
+        task_ids = list(due_times)
+        try:
+            # Получаем неподтвержденные задачи из числа наступивших
+            tasks = storage.unconfirmed_tasks(chat_id, db_name, task_ids)
+
+            # Подтверждённые или удалённые мимо бота задачи убираем из очереди
+            found_ids = {task[0] for task in tasks}
+            for task_id in task_ids:
+                if task_id not in found_ids:
+                    unschedule_task(chat_id, db_name, task_id)
+
+            # Закрепляем за собой задачи, о которых пора напомнить. Остальные ждут своего
+            # времени: о них уже напомнил другой процесс или их держит его аренда
+            lease_until = now + DELIVERY_LEASE
+            claims = []
+            for task_id, _, _, due_at, notified_at, notify_count, task_lease in tasks:
+                retry_at = max(next_reminder_time(due_at, notified_at, notify_count), task_lease or 0)
+                if retry_at > now:
+                    schedule_task(chat_id, db_name, task_id, retry_at)
+                else:
+                    claims.append((task_id, notified_at))
+            claimed = set()
+            if claims:
+                claimed = set(storage.claim_tasks(chat_id, db_name, claims, lease_owner(), now, lease_until))
+
+            for task_id, notified_at in claims:
+                if task_id not in claimed:
+                    # Другой процесс успел раньше - проверим после его аренды
+                    schedule_task(chat_id, db_name, task_id, lease_until)
+
+            for task in tasks:
+                task_id, task_text, time_send, _, _, notify_count, _ = task
+                if task_id not in claimed:
                     continue
 
-                chat_id = int(user_folder)
-                user_dbs = get_user_dbs(chat_id)
-
-                for db_name in user_dbs:
-                    clean_db_name = db_name.replace(".sqlite", "")
-                    db_path = f"users_data/{user_folder}/{db_name}"
-
-                    try:
-                        conn = sqlite3.connect(db_path)
-                        cursor = conn.cursor()
-
-                        # Проверяем и добавляем недостающие столбцы
-                        cursor.execute("PRAGMA table_info(problems)")
-                        columns = [col[1] for col in cursor.fetchall()]
-
-                        if 'confirmed' not in columns:
-                            cursor.execute("ALTER TABLE problems ADD COLUMN confirmed BOOLEAN DEFAULT FALSE")
-                        if 'last_notification' not in columns:
-                            cursor.execute("ALTER TABLE problems ADD COLUMN last_notification DATETIME")
-
-                        conn.commit()
-
-                        # Получаем неподтвержденные задачи
-                        cursor.execute(
-                            """SELECT problem_id, problem, time_send, last_notification 
-                               FROM problems 
-                               WHERE confirmed = FALSE AND time_send <= ?""",
-                            (current_time_str,)
-                        )
-                        tasks = cursor.fetchall()
-
-                        for task in tasks:
-                            task_id, task_text, time_send, last_notif = task
-
-                            # Преобразуем last_notif в aware datetime если оно есть
-                            if last_notif:
-                                last_notif_dt = datetime.strptime(last_notif, "%Y-%m-%d %H:%M:%S")
-                                last_notif_dt = msk_timezone.localize(last_notif_dt)
-                            else:
-                                last_notif_dt = None
-
-                            # Проверяем необходимость напоминания
-                            if last_notif_dt is None:
-                                need_reminder = True
-                            else:
-                                time_diff = (now_msk - last_notif_dt).total_seconds()
-                                need_reminder = time_diff >= 120  # 2 минуты
-
-                            if need_reminder:
-                                markup = types.InlineKeyboardMarkup()
-                                confirm_btn = types.InlineKeyboardButton(
-                                    "✅ Подтвердить выполнение",
-                                    callback_data=f"confirm_task:{clean_db_name}:{task_id}"
-                                )
-                                markup.add(confirm_btn)
-
-                                bot.send_message(
-                                    chat_id,
-                                    f"🔔 Напоминание\nЗадача: {task_text}\nВремя: {time_send}",
-                                    reply_markup=markup
-                                )
-
-                                # Обновляем время последнего уведомления
-                                cursor.execute(
-                                    "UPDATE problems SET last_notification = ? WHERE problem_id = ?",
-                                    (current_time_str, task_id)
-                                )
-                                conn.commit()
-
-                    except Exception as e:
-                        print(f"Ошибка при работе с БД {db_name}: {e}")
-                    finally:
-                        if conn:
-                            conn.close()
-
-            time.sleep(60 - datetime.now().second)
+                markup = types.InlineKeyboardMarkup()
+                confirm_btn = types.InlineKeyboardButton(
+                    "✅ Подтвердить выполнение",
+                    callback_data=encode_callback("confirm_task", db_name, task_id)
+                )
+                markup.add(confirm_btn)
+
+                # Отправка и запись last_notification - в очереди отправки
+                if send_queue.put_reminder(
+                    chat_id,
+                    db_name,
+                    task_id,
+                    now,
+                    due_times[task_id],
+                    f"🔔 Напоминание\nЗадача: {task_text}\nВремя: {time_send}",
+                    markup
+                ):
+                    count_metric("reminders_queued_total")
+
+                # Повторное напоминание, пока задачу не подтвердят
+                schedule_task(chat_id, db_name, task_id, now + renotify_delay(notify_count + 1))
+
+        except Exception as e:
+            report_error("reminder", f"Ошибка при работе с БД {db_name}: {e}")
+            retry_due_tasks(chat_id, db_name, task_ids, now + RENOTIFY_INTERVAL)
+
+
+def retry_due_tasks(chat_id, db_name, task_ids, retry_at):
+    # Не теряем задачи: попробуем снова при следующем напоминании
+    with due_lock:
+        tasks_in_db = due_index.get((chat_id, db_name), {})
+        retry_ids = [t for t in task_ids if t in tasks_in_db and tasks_in_db[t] is None]
+    for task_id in retry_ids:
+        schedule_task(chat_id, db_name, task_id, retry_at)
+
+
+def notify_digests(now, due_lists):
+    # Одно сообщение на чат за проход, сколько бы задач у него ни наступило
+    by_chat = {}
+    for (chat_id, db_name), due_times in due_lists.items():
+        by_chat.setdefault(chat_id, {})[db_name] = due_times
 
+    for chat_id, lists in by_chat.items():
+        try:
+            notify_digest(chat_id, lists, now)
         except Exception as e:
-            print(f"Ошибка в check_and_notify: {e}")
+            report_error("reminder", f"Ошибка дайджеста чата {chat_id}: {e}")
+            for db_name, due_times in lists.items():
+                retry_due_tasks(chat_id, db_name, list(due_times), now + RENOTIFY_INTERVAL)
+
+
+def notify_digest(chat_id, lists, now):
+    # В дайджест попадают все просроченные задачи чата, не только наступившие сейчас
+    tasks = chat_overdue_tasks(chat_id, now)
+
+    # Подтверждённые или удалённые мимо бота задачи убираем из очереди
+    found = {(db_name, task_id) for db_name, task_id, *_ in tasks}
+    for db_name, due_times in lists.items():
+        for task_id in due_times:
+            if (db_name, task_id) not in found:
+                unschedule_task(chat_id, db_name, task_id)
+
+    # Задачи под действующей арендой (чужой или ещё не снятой своей) сейчас доставляются
+    lease_until = now + DELIVERY_LEASE
+    claims = {}  # db_name -> [(task_id, notified_at)]
+    for db_name, task_id, _, _, _, notified_at, task_lease in tasks:
+        if task_lease and task_lease > now:
+            schedule_task(chat_id, db_name, task_id, task_lease)
+        else:
+            claims.setdefault(db_name, []).append((task_id, notified_at))
+    claimed = set()
+    for db_name, list_claims in claims.items():
+        for task_id in storage.claim_tasks(chat_id, db_name, list_claims, lease_owner(), now, lease_until):
+            claimed.add((db_name, task_id))
+        for task_id, _ in list_claims:
+            if (db_name, task_id) not in claimed:
+                schedule_task(chat_id, db_name, task_id, lease_until)
+
+    tasks = [task for task in tasks if (task[0], task[1]) in claimed]
+    if not tasks:
+        return
+
+    text, markup = render_digest(tasks, 0)
+    due_at = min(min(due_times.values()) for due_times in lists.values())
+    deliveries = [(db_name, task_id, now) for db_name, task_id, *_ in tasks]
+    if send_queue.put_digest(chat_id, deliveries, due_at, text, markup):
+        count_metric("reminders_queued_total")
+        count_metric("digest_tasks_total", len(tasks))
+
+    # Все задачи чата переносим на одно время, чтобы следующий дайджест снова был один.
+    # Пауза - по задаче с наименьшим числом напоминаний: новая не ждёт паузы старых
+    next_time = now + renotify_delay(min(task[4] for task in tasks) + 1)
+    for db_name, task_id, *_ in tasks:
+        schedule_task(chat_id, db_name, task_id, next_time)
+
+
+def notification_time_str(notified_at):
+    # last_notification - для людей, в поясе по умолчанию, как до появления notified_at
+    return datetime.fromtimestamp(notified_at, get_timezone(DEFAULT_TIMEZONE)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def wait_for_next_due():
+    # Спим до ближайшей задачи (или повторного напоминания); schedule_task
+    # будит раньше, если добавлена задача с более ранним временем
+    with due_lock:
+        next_time = next_due_time()
+        timeout = MAX_IDLE_WAIT
+        if next_time is not None:
+            timeout = min(timeout, next_time - time.time())
+        if timeout > 0:
+            due_wakeup.wait(timeout)
+
+
+def check_and_notify():
+    while True:
+        try:
+            with timed("reminder_pass"):
+                notify_due_tasks(time.time())
+            wait_for_next_due()
+
+        except Exception as e:
+            report_error("reminder_loop", f"Ошибка в check_and_notify: {e}")
             time.sleep(10)
 
 
-def update_existing_dbs():
-    for user_folder in os.listdir("users_data"):
-        if not user_folder.isdigit():
+def archive_list(chat_id, db_name, confirmed_before, expired_before):
+    # Переносит задачи порциями: сначала запись в архив, потом удаление из списка.
+    # После сбоя между ними порция просто перенесётся ещё раз (INSERT OR REPLACE)
+    moved = 0
+    while True:
+        rows = storage.archivable_tasks(chat_id, db_name, confirmed_before, expired_before, ARCHIVE_BATCH_SIZE)
+        if not rows:
+            return moved
+
+        with db_connection((None, ARCHIVE_DB_PATH), ARCHIVE_DB_PATH, ARCHIVE_MIGRATIONS) as conn:
+            conn.executemany(
+                """INSERT OR REPLACE INTO problems_archive
+                   (chat_id, list_name, problem_id, problem, time_create, time_send, confirmed,
+                    last_notification, recurrence)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(chat_id, db_name, *row) for row in rows]
+            )
+            conn.commit()
+
+        task_ids = [row[0] for row in rows]
+        storage.delete_tasks(chat_id, db_name, task_ids)
+        for task_id in task_ids:
+            unschedule_task(chat_id, db_name, task_id)
+        invalidate_listing(chat_id, db_name)
+        moved += len(rows)
+        if len(rows) < ARCHIVE_BATCH_SIZE:
+            return moved
+
+
+def compact_storage(idle_seconds):
+    now = int(time.time())
+    confirmed_before = now - ARCHIVE_AFTER_DAYS * 86400
+    expired_before = 0
+    if EXPIRE_AFTER_DAYS > 0:
+        expired_before = now - EXPIRE_AFTER_DAYS * 86400
+
+    archived = Counter()
+    reclaimed = Counter()
+    # Простой БД определяем до архивации - она сама обращается к БД
+    idle = {}  # ключ пула -> список, через который очищать файл, или None
+    for chat_id, db_name in storage.iter_lists():
+        key = storage.pool_key(chat_id, db_name)
+        if key not in idle:
+            idle[key] = (chat_id, db_name) if db_idle(key, idle_seconds) else None
+        try:
+            archived[chat_id] += archive_list(chat_id, db_name, confirmed_before, expired_before)
+        except Exception as e:
+            report_error("archive", f"Ошибка архивации {chat_id}/{db_name}: {e}")
+
+    for key, target in idle.items():
+        if target is None:
             continue
+        try:
+            reclaimed[key[0]] += storage.vacuum(*target)
+        except Exception as e:
+            report_error("vacuum", f"Ошибка сжатия {target[0]}/{target[1]}: {e}")
+
+    for chat_id in set(archived) | set(reclaimed):
+        if archived[chat_id] or reclaimed[chat_id]:
+            compaction_report[chat_id] = (archived[chat_id], reclaimed[chat_id])
+            owner = "общий файл" if chat_id is None else f"пользователь {chat_id}"
+            print(f"Сжатие: {owner} - в архив {archived[chat_id]} задач, освобождено {reclaimed[chat_id] // 1024} КБ")
+    print(f"Сжатие завершено: в архив {sum(archived.values())} задач, "
+          f"освобождено {sum(reclaimed.values()) // 1024} КБ")
 
-        for db_file in os.listdir(f"users_data/{user_folder}"):
-            if db_file.endswith(".sqlite"):
-                conn = sqlite3.connect(f"users_data/{user_folder}/{db_file}")
-                cursor = conn.cursor()
 
-                # Добавляем столбцы, если их нет
-                cursor.execute("PRAGMA table_info(problems)")
-                columns = [col[1] for col in cursor.fetchall()]
+def compaction_loop():
+    while True:
+        time.sleep(COMPACTION_INTERVAL)
+        try:
+            with timed("compaction"):
+                compact_storage(COMPACTION_IDLE_SECONDS)
+            # Истёкшие диалоги - их строки больше никто не прочитает
+            purge_next_steps(time.time())
+        except Exception as e:
+            report_error("compaction_loop", f"Ошибка в compaction_loop: {e}")
 
-                if "confirmed" not in columns:
-                    cursor.execute("ALTER TABLE problems ADD COLUMN confirmed BOOLEAN DEFAULT FALSE")
 
-                if "last_notification" not in columns:
-                    cursor.execute("ALTER TABLE problems ADD COLUMN last_notification DATETIME")
+def shard_of(chat_id, shards):
+    return zlib.crc32(str(chat_id).encode()) % shards
 
-                conn.commit()
-                conn.close()
+
+def apply_shard_events(events):
+    # Изменения очереди из основного процесса (обработчиков команд)
+    while True:
+        event, chat_id, db_name, *args = events.get()
+        try:
+            if event == "schedule":
+                storage.remember_list(chat_id, db_name)
+                schedule_task(chat_id, db_name, *args)
+            elif event == "unschedule":
+                unschedule_task(chat_id, db_name, *args)
+            elif event == "drop_list":
+                unschedule_db(chat_id, db_name)
+                storage.forget_list(chat_id, db_name)
+        except Exception as e:
+            report_error("shard_event", f"Ошибка обработки события {event} для {chat_id}/{db_name}: {e}")
+
+
+def run_reminder_shard(shard, shards, events):
+    # Точка входа процесса напоминаний: своя очередь, свой пул соединений и
+    # своя очередь отправки, только для чатов своей доли
+    global reminder_shard
+    reminder_shard = (shard, shards)
+
+    threading.Thread(target=apply_shard_events, args=(events,), daemon=True).start()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + shard)
+    warm_up_storage()
+    # Чаты поделены между процессами, так что лимит на чат у каждого целый,
+    # а общий лимит бота - только своя доля
+    rate = GLOBAL_SEND_RATE / shards
+    send_queue.global_bucket = TokenBucket(rate, capacity=max(1, rate))
+    send_queue.start()
+    check_and_notify()
+
+
+class ReminderCoordinator:
+    # Запускает процессы напоминаний, пересылает им изменения очереди и
+    # перезапускает упавшие. Перезапущенный процесс заново загружает свою долю
+    # из хранилища, так что события, потерянные вместе с ним, не теряют задач.
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.context = multiprocessing.get_context("spawn")
+        self.events = [None] * shards
+        self.processes = [None] * shards
+
+    def start(self):
+        for shard in range(self.shards):
+            self.start_shard(shard)
+        threading.Thread(target=self.supervise, daemon=True).start()
+
+    def start_shard(self, shard):
+        events = self.context.Queue()
+        process = self.context.Process(
+            target=run_reminder_shard,
+            args=(shard, self.shards, events),
+            name=f"reminders-{shard}",
+            daemon=True
+        )
+        process.start()
+        self.events[shard] = events
+        self.processes[shard] = process
+
+    def publish(self, chat_id, event):
+        self.events[shard_of(chat_id, self.shards)].put(event)
+
+    def supervise(self):
+        while True:
+            time.sleep(5)
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"Процесс напоминаний {shard} завершился (код {process.exitcode}), перезапуск")
+                    self.start_shard(shard)
+
+
+class AsyncBotBridge:
+    # В asyncio-режиме подменяет bot для обработчиков: они выполняются в пуле
+    # потоков (там же все обращения к хранилищу), а вызовы Bot API уходят в цикл
+    # событий и поток не ждут
+
+    def __init__(self, async_bot, loop):
+        self.async_bot = async_bot
+        self.loop = loop
+
+    def __getattr__(self, name):
+        method = getattr(self.async_bot, name)
+
+        def call(*args, **kwargs):
+            future = asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self.loop)
+            future.add_done_callback(self.report_error)
+            return future
+
+        return call
+
+    @staticmethod
+    def report_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            report_error("bot_api", f"Ошибка вызова Bot API: {future.exception()}")
+
+
+def run_async_bot():
+    # Те же обработчики, что и у bot.polling, но на одном цикле событий:
+    # поток из пула занят только пока обработчик работает с хранилищем
+    from telebot.async_telebot import AsyncTeleBot  # нужен aiohttp
+
+    sync_bot = bot
+    async_bot = AsyncTeleBot(TOKEN)
+    executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS)
+
+    async def main_loop():
+        global bot
+        loop = asyncio.get_running_loop()
+        bridge = AsyncBotBridge(async_bot, loop)
+        bot = bridge
+
+        def in_executor(function):
+            async def handler(obj):
+                await loop.run_in_executor(executor, function, obj)
+            return handler
+
+        async def next_step_in_executor(message):
+            return await loop.run_in_executor(executor, next_step_filter, message)
+
+        # handle_next_step идёт первым и здесь. С NEXT_STEP_SHARED его фильтр читает
+        # STATE_DB_PATH - не в цикле событий, а в пуле потоков
+        for handler in sync_bot.message_handlers:
+            filters = handler["filters"]
+            if NEXT_STEP_SHARED and filters.get("func") is next_step_filter:
+                filters = dict(filters, func=next_step_in_executor)
+            async_bot.register_message_handler(in_executor(handler["function"]), **filters)
+        for handler in sync_bot.callback_query_handlers:
+            async_bot.register_callback_query_handler(in_executor(handler["function"]), **handler["filters"])
+
+        try:
+            await async_bot.infinity_polling()
+        finally:
+            await async_bot.close_session()
+
+    asyncio.run(main_loop())
+
+
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return 0
+
+
+class WebhookDispatcher:
+    # Пул обработчиков обновлений из вебхука. У каждого потока своя ограниченная
+    # очередь, чат всегда попадает в одну и ту же - так его обновления
+    # обрабатываются по порядку
+
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(max(1, queue_size // workers)) for _ in range(workers)]
+
+    def start(self):
+        for updates in self.queues:
+            threading.Thread(target=self.worker, args=(updates,), daemon=True).start()
+
+    def submit(self, update):
+        updates = self.queues[shard_of(update_chat_id(update), len(self.queues))]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def worker(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                with timed("webhook_update"):
+                    bot.process_new_updates([update])
+            except Exception as e:
+                report_error("webhook", f"Ошибка обработки обновления {update.update_id}: {e}")
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    dispatcher = None
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.reply(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.reply(403)
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            update = types.Update.de_json(json.loads(body))
+        except Exception:
+            self.reply(400)
+            return
+
+        # Очередь чата переполнена - Telegram повторит доставку позже
+        status = 200 if self.dispatcher.submit(update) else 503
+        count_metric("webhook_updates_total", status=status)
+        self.reply(status)
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_webhook_server():
+    # Обработчики вызываются прямо в потоках диспетчера, без пула TeleBot
+    bot.threaded = False
+    dispatcher = WebhookDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    dispatcher.start()
+    WebhookHandler.dispatcher = dispatcher
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    print(f"Вебхук слушает http://{WEBHOOK_HOST}:{server.server_port}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def render_metrics():
+    with metrics_lock:
+        counters = sorted(metric_counters.items(), key=lambda item: (item[0][0], str(item[0][1])))
+        histograms = sorted(metric_histograms.items(), key=lambda item: (item[0][0], str(item[0][1])))
+    counters += [((f"storage_{name}_total", ()), value) for name, value in sorted(storage_counters.items())]
+    histograms.append((("reminder_lag_seconds", ()), reminder_lag))
+    with due_lock:
+        scheduled = sum(len(tasks) for tasks in due_index.values())
+    with pool_lock:
+        connections = len(open_connections)
+    gauges = [
+        ("reminders_scheduled", scheduled),
+        ("send_queue_size", send_queue.jobs.qsize()),
+        ("send_queue_delayed", len(send_queue.delayed)),
+        ("db_connections_open", connections),
+        ("listing_cache_lists", len(listing_cache)),
+    ]
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, value in gauges:
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    for (name, labels), histogram in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        counts, total, count = histogram.snapshot()
+        seen = 0
+        for bound, bucket in zip(histogram.bounds + ["+Inf"], counts):
+            seen += bucket
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {seen}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    # Раз в interval секунд снимает стеки всех потоков и считает одинаковые.
+    # Отчёт - свёрнутые стеки "внешняя;...;внутренняя N" (flamegraph.pl, speedscope)
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self.stop_event = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.stop_event is not None:
+                return False
+            self.samples.clear()
+            self.stop_event = threading.Event()
+            threading.Thread(target=self.run, args=(self.stop_event,), daemon=True).start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            if self.stop_event is None:
+                return False
+            self.stop_event.set()
+            self.stop_event = None
+        return True
+
+    def run(self, stop_event):
+        own = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.samples.update(stacks)
+
+    def report(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.reply(200, render_metrics(), "text/plain; version=0.0.4")
+        elif self.path == "/profile":
+            self.reply(200, profiler.report())
+        else:
+            self.reply(404, "")
+
+    def do_POST(self):
+        if self.path == "/profile/start":
+            self.reply(200, "started\n" if profiler.start() else "already running\n")
+        elif self.path == "/profile/stop":
+            self.reply(200, "stopped\n" if profiler.stop() else "not running\n")
+        else:
+            self.reply(404, "")
+
+    def reply(self, status, text, content_type="text/plain"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    except OSError as e:
+        report_error("metrics", f"Не удалось запустить сервер метрик на порту {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if PROFILE_ON_START:
+        profiler.start()
+    print(f"Метрики: http://{METRICS_HOST}:{server.server_port}/metrics")
+    return server
+
+
+def migrate_to_single_file():
+    # python main.py migrate_storage - переносит users_data/<chat_id>/*.sqlite в STORAGE_DB_PATH
+    target = SingleFileStorage(STORAGE_DB_PATH)
+    imported = target.import_file_storage(FileStorage())
+    print(f"Готово: перенесено списков - {imported}")
 
 
 if __name__ == '__main__':
-    update_existing_dbs()  # Вызываем один раз
-    reminder_thread = threading.Thread(target=check_and_notify, daemon=True)
-    reminder_thread.start()
-    bot.polling(none_stop=True)
+    # python main.py [polling | async | webhook | migrate_storage | compact]
+    mode = sys.argv[1] if len(sys.argv) > 1 else "polling"
+    if mode == "migrate_storage":
+        migrate_to_single_file()
+        sys.exit(0)
+    if mode == "compact":
+        # Разовый проход, не дожидаясь простоя БД
+        compact_storage(0)
+        sys.exit(0)
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    # Диалоги, начатые до перезапуска
+    load_next_steps()
+
+    # С процессами напоминаний основной процесс только мигрирует БД, очередь
+    # напоминаний загружает каждый процесс для своей доли чатов
+    load_queue = REMINDER_SHARDS == 0
+    if MIGRATE_IN_BACKGROUND:
+        threading.Thread(target=warm_up_storage, kwargs={"load_queue": load_queue}, daemon=True).start()
+    else:
+        warm_up_storage(load_queue=load_queue)
+
+    if REMINDER_SHARDS > 0:
+        reminder_coordinator = ReminderCoordinator(REMINDER_SHARDS)
+        reminder_coordinator.start()
+    else:
+        send_queue.start()
+        reminder_thread = threading.Thread(target=check_and_notify, daemon=True)
+        reminder_thread.start()
+    threading.Thread(target=compaction_loop, daemon=True).start()
+
+    if mode == "async":
+        run_async_bot()
+    elif mode == "webhook":
+        run_webhook_server()
+    else:
+        bot.polling(none_stop=True)
 
 
 